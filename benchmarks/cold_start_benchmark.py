@@ -0,0 +1,179 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(
+    description="Measure the cold start of the edge Lambda and container entry points in fresh interpreters")
+parser.add_argument('--entries', nargs='+', default=['edge', 'app'], choices=['edge', 'app'],
+                    help="entry modules: edge for Lambda@Edge, app for the Flask container")
+parser.add_argument('--runs', type=int, default=20, help="fresh interpreters started per entry")
+parser.add_argument('--catalog-size', type=int, default=100, help="number of apps in the catalog")
+parser.add_argument('--matched', type=int, default=5, help="number of binaries the device matches")
+parser.add_argument('--payload-type', default='metadataonly', help="payload type of the first request")
+parser.add_argument('--importtime', action='store_true', help="also list the slowest imports of each entry")
+parser.add_argument('--output', help="file to append one JSON result per entry to")
+parser.add_argument('--child', help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+runtime_dir = os.path.join(benchmarks_dir, '..', 'runtime')
+
+
+class RecordingClients(dict):
+    """config.clients stand-in remembering which services were asked for"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.used = []
+
+    def get(self, service_name, default=None):
+        if service_name not in self.used:
+            self.used.append(service_name)
+        return super().get(service_name, default)
+
+
+def run_child(entry):
+    """Import an entry module and serve its first requests, in the interpreter this was started in"""
+    started = time.perf_counter()
+    entry_module = __import__(entry)
+    import_ms = (time.perf_counter() - started) * 1000
+    modules = {'modules_loaded': len(sys.modules), 'flask_loaded': 'flask' in sys.modules,
+               'boto3_loaded': 'boto3' in sys.modules}
+
+    sys.path.insert(0, benchmarks_dir)
+    import config
+    import fakes
+    items, blobs = fakes.generate_catalog(args.catalog_size, 1024, 1)
+    clients = RecordingClients({
+        's3': fakes.FakeS3(blobs),
+        'dynamodb': fakes.FakeDynamoDB(items),
+        'ssm': fakes.FakeSSM({
+            config.ssm_parameter_names['binaries_bucket_name']: fakes.bucket_name,
+            config.ssm_parameter_names['dynamo_table_name']: fakes.table_name
+        })
+    })
+    config.clients = clients
+    os.environ[config.environment_variable_names['binaries_bucket_name']] = fakes.bucket_name
+    os.environ[config.environment_variable_names['dynamo_table_name']] = fakes.table_name
+    query_string = '&'.join('{0}={1}'.format(k, v) for k, v in fakes.device_params(args.matched).items())
+    query_string += '&payloadType=' + args.payload_type
+
+    if entry == 'edge':
+        event = {'Records': [{'cf': {'request': {
+            'uri': '/package', 'method': 'GET', 'querystring': query_string, 'headers': {}}}}]}
+
+        def request():
+            return entry_module.edgelambda_handler(event, None)['status']
+    else:
+        test_client = entry_module.flapp.test_client()
+
+        def request():
+            response = test_client.get('/package?' + query_string)
+            response.close()
+            return response.status_code
+
+    durations = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(2):
+            started = time.perf_counter()
+            status_code = request()
+            durations.append((time.perf_counter() - started) * 1000)
+    if status_code != 200:
+        raise RuntimeError("First request returned a {0}".format(status_code))
+
+    # The stand-ins skip building the boto3 clients, which a real cold start pays for on first use
+    started = time.perf_counter()
+    for service_name in clients.used:
+        del clients[service_name]
+        config.get_client(service_name)
+    client_ms = (time.perf_counter() - started) * 1000
+
+    print(json.dumps({
+        'import_ms': import_ms,
+        'first_request_ms': durations[0],
+        'warm_request_ms': durations[1],
+        'client_ms': client_ms,
+        # What the first device waits for on a cold start: loading the module, then its first request
+        'init_ms': import_ms + durations[0] + client_ms,
+        'clients': clients.used,
+        **modules
+    }))
+
+
+def child_environment(entry, cache_dir):
+    env = dict(os.environ, BINARY_CACHE_DIR=cache_dir, CATALOG_MODE='keys', PYTHONPATH=runtime_dir)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    if entry == 'edge':
+        env['AWS_EXECUTION_ENV'] = 'AWS_Lambda_benchmark'
+    return env
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def print_slowest_imports(entry, env, top=15):
+    """Print the imports of an entry module taking the longest, children included, from python -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + entry],
+                            env=env, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    for cumulative_us, module in sorted(imports, reverse=True)[:top]:
+        print("    {0:>9.1f}ms {1}".format(cumulative_us / 1000, module))
+
+
+if args.child:
+    run_child(args.child)
+    sys.exit(0)
+
+records = []
+for entry in args.entries:
+    cache_dir = tempfile.mkdtemp(prefix='ota-cold-start-')
+    try:
+        env = child_environment(entry, cache_dir)
+        runs = []
+        for _ in range(args.runs):
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', entry] + sys.argv[1:],
+                                    env=env, capture_output=True, text=True, check=True)
+            runs.append(json.loads(result.stdout.splitlines()[-1]))
+        record = {
+            'entry': entry,
+            'runs': args.runs,
+            'catalog_size': args.catalog_size,
+            'matched': args.matched,
+            'payload_type': args.payload_type,
+            'python': platform.python_version(),
+            'time': int(time.time()),
+            'clients': runs[0]['clients'],
+            'modules_loaded': runs[0]['modules_loaded'],
+            'flask_loaded': runs[0]['flask_loaded']
+        }
+        for metric in ('import_ms', 'first_request_ms', 'client_ms', 'init_ms', 'warm_request_ms'):
+            values = sorted(run[metric] for run in runs)
+            record[metric.replace('_ms', '_p50_ms')] = round(percentile(values, 0.5), 3)
+            record[metric.replace('_ms', '_p99_ms')] = round(percentile(values, 0.99), 3)
+        records.append(record)
+        print("{0:<5} import p50 {1:>8.1f}ms  first request {2:>7.1f}ms  clients {3:>7.1f}ms {4}  init p50 {5:>8.1f}ms p99 {6:>8.1f}ms  "
+              "warm {7:>6.2f}ms  {8} modules{9}".format(
+                  entry, record['import_p50_ms'], record['first_request_p50_ms'], record['client_p50_ms'],
+                  ','.join(record['clients']), record['init_p50_ms'], record['init_p99_ms'], record['warm_request_p50_ms'],
+                  record['modules_loaded'], ', Flask loaded' if record['flask_loaded'] else ''))
+        if args.importtime:
+            print_slowest_imports(entry, env)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+if args.output:
+    with open(args.output, 'a') as output_file:
+        for record in records:
+            output_file.write(json.dumps(record, sort_keys=True) + "\n")
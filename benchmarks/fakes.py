@@ -0,0 +1,192 @@
+import io
+import random
+import re
+import threading
+import time
+import hashlib
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+from catalog import attribute_index_row
+
+serializer = TypeSerializer()
+
+bucket_name = 'ota-benchmark-binaries'
+table_name = 'ota-benchmark-versions'
+
+
+def generate_catalog(num_apps, binary_size, seed=0):
+    """
+    Synthetic catalog of an OS image and num_apps apps in prod, with a binary of binary_size bytes each.
+    Binaries are half random and half zeros, so they compress about as well as typical firmware. The catalog's
+    version marker is the seed, so catalogs of different seeds never share cached results.
+    Returns (items, blobs by S3 key).
+    """
+    rnd = random.Random(seed)
+    items = [{'app': '__catalog__', 'env': 'version', 'version': seed}]
+    blobs = dict()
+    for i in range(num_apps + 1):
+        app = 'os_armv8' if i == 0 else 'app{0:05d}'.format(i - 1)
+        version = '1.0.{0}'.format(seed)
+        data = rnd.randbytes(binary_size // 2) + bytes(binary_size - binary_size // 2)
+        s3_key = '{0}_{1}'.format(app, version)
+        blobs[s3_key] = data
+        item = {
+            'app': app,
+            'env': 'prod',
+            'version': version,
+            'url': 's3://{0}/{1}'.format(bucket_name, s3_key),
+            'md5': hashlib.md5(data).hexdigest(),
+            'size': len(data)
+        }
+        if i > 0:
+            # Every tenth app is also flagged for a device attribute, which exercises the attribute lookups
+            item['deviceAttr'] = {'group{0}'.format(i % 10): True}
+        items.append(item)
+    return items, blobs
+
+
+def device_params(matched):
+    """/package params of a device that matches the OS image and matched - 1 apps"""
+    return {'cpuarch': 'armv8', **{'app{0:05d}'.format(i): 'prod' for i in range(matched - 1)}}
+
+
+class Latency:
+    """Sleeps a fixed time per call, to stand in for the network round trip of a real service"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        if self.seconds:
+            time.sleep(self.seconds)
+
+
+class FakeBody:
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+    def close(self):
+        pass
+
+
+class FakeS3:
+    """In-process S3 client serving the calls handlers.py makes from a dict of objects"""
+
+    def __init__(self, blobs, latency=0):
+        self.blobs = blobs
+        self.latency = Latency(latency)
+
+    def get_object(self, Bucket, Key, IfMatch=None):
+        self.latency()
+        if Key not in self.blobs:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        data = self.blobs[Key]
+        if IfMatch and IfMatch.strip('"') != hashlib.md5(data).hexdigest():
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        return {'Body': FakeBody(data), 'ContentLength': len(data)}
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        self.latency()
+        Fileobj.write(self.blobs[Key])
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.latency()
+        self.blobs[Key] = Body
+
+
+class FakePaginator:
+
+    def __init__(self, pages):
+        self._pages = pages
+
+    def paginate(self, **kwargs):
+        return self._pages(**kwargs)
+
+
+class FakeDynamoDB:
+    """
+    In-process low-level DynamoDB client over a list of items, covering the PartiQL, BatchGetItem, GSI query, scan and
+    GetItem calls of every catalog mode
+    """
+
+    page_size = 1000
+    statement_pattern = re.compile(r"\((?:app = '([^']*)'|deviceAttr\.(\w+) = true) AND env = '([^']*)'\)")
+
+    def __init__(self, items, latency=0):
+        self.latency = Latency(latency)
+        self.rows = list(items)
+        for item in items:
+            for attribute in item.get('deviceAttr', {}):
+                self.rows.append(attribute_index_row(item, attribute))
+        self.by_key = {(row['app'], row['env']): row for row in self.rows}
+        self.by_attr_key = dict()
+        for row in self.rows:
+            if 'attrKey' in row:
+                self.by_attr_key.setdefault(row['attrKey'], []).append(row)
+
+    @staticmethod
+    def serialize(item):
+        return {k: serializer.serialize(v) for k, v in item.items()}
+
+    def execute_statement(self, Statement, **kwargs):
+        self.latency()
+        terms = self.statement_pattern.findall(Statement)
+        matches = []
+        for item in self.rows:
+            if 'attrKey' in item:
+                continue
+            for app, attribute, env in terms:
+                if item['env'] == env and (item['app'] == app if app else item.get('deviceAttr', {}).get(attribute) is True):
+                    matches.append(self.serialize(item))
+                    break
+        return {'Items': matches}
+
+    def batch_get_item(self, RequestItems):
+        self.latency()
+        responses = dict()
+        for table, request in RequestItems.items():
+            keys = [(k['app']['S'], k['env']['S']) for k in request['Keys']]
+            responses[table] = [self.serialize(self.by_key[k]) for k in keys if k in self.by_key]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def get_item(self, TableName, Key):
+        self.latency()
+        item = self.by_key.get((Key['app']['S'], Key['env']['S']))
+        return {'Item': self.serialize(item)} if item else {}
+
+    def get_paginator(self, operation):
+        if operation == 'scan':
+            return FakePaginator(self._scan)
+        if operation == 'query':
+            return FakePaginator(self._query)
+        raise ValueError("Unsupported paginator {0}".format(operation))
+
+    def _scan(self, TableName, **kwargs):
+        for i in range(0, len(self.rows), self.page_size):
+            self.latency()
+            yield {'Items': [self.serialize(item) for item in self.rows[i:i + self.page_size]]}
+
+    def _query(self, TableName, IndexName, KeyConditionExpression, ExpressionAttributeValues, **kwargs):
+        self.latency()
+        rows = self.by_attr_key.get(ExpressionAttributeValues[':attrKey']['S'], [])
+        yield {'Items': [self.serialize(row) for row in rows]}
+
+
+class FakeSSM:
+    """In-process SSM client holding the parameters the edge Lambda reads its settings from"""
+
+    def __init__(self, parameters, latency=0):
+        self.parameters = parameters
+        self.latency = Latency(latency)
+
+    def get_parameters(self, Names):
+        self.latency()
+        return {'Parameters': [{'Name': name, 'Value': self.parameters[name]} for name in Names if name in self.parameters]}
@@ -0,0 +1,234 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the package handler against in-process S3, DynamoDB and SSM stand-ins, no stack needed")
+parser.add_argument('--catalog-sizes', type=int, nargs='+', default=[100, 1000], help="number of apps in the catalog")
+parser.add_argument('--matched', type=int, nargs='+', default=[1, 5, 20], help="number of binaries a device matches")
+parser.add_argument('--binary-sizes', type=int, nargs='+', default=[65536, 1048576], help="size of each binary in bytes")
+parser.add_argument('--payload-types', nargs='+', default=['metadataonly', 'compact', 'fullpayload'])
+parser.add_argument('--etag-hit-ratios', type=float, nargs='+', default=[0.0, 0.9],
+                    help="fraction of package requests that present an up to date manifest ETag")
+parser.add_argument('--encoding', default='gzip', help="compression of full payloads")
+parser.add_argument('--iterations', type=int, default=50, help="timed calls per stage and scenario")
+parser.add_argument('--concurrency', type=int, default=1, help="threads issuing package_handler calls")
+parser.add_argument('--catalog-mode', default='keys', choices=['keys', 'query', 'snapshot'])
+parser.add_argument('--s3-latency-ms', type=float, default=0, help="simulated round trip of each S3 call")
+parser.add_argument('--dynamo-latency-ms', type=float, default=0, help="simulated round trip of each DynamoDB call")
+parser.add_argument('--edge', action='store_true', help="run as the edge Lambda does, reading settings from SSM")
+parser.add_argument('--output', help="file to append one JSON result per scenario and stage to")
+parser.add_argument('--compare', help="results file of a previous run to compare latencies against")
+parser.add_argument('--threshold', type=float, default=1.2,
+                    help="p50 or p99 latency ratio to the compared run above which a result counts as a regression")
+args = parser.parse_args()
+
+# The app reads its settings when it is imported, so they are set first
+binary_cache_dir = tempfile.mkdtemp(prefix='ota-benchmark-')
+os.environ['BINARY_CACHE_DIR'] = binary_cache_dir
+os.environ['CATALOG_MODE'] = args.catalog_mode
+os.environ['CATALOG_POLL_SECONDS'] = '3600'
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+if args.edge:
+    os.environ['AWS_EXECUTION_ENV'] = 'AWS_Lambda_benchmark'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'runtime'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import archive
+import config
+import fakes
+import handlers
+
+stages = ['find_matching_apps', 'build_packages_payload', 'package_handler']
+
+
+def install_fakes(items, blobs):
+    """Point the app at fresh stand-ins holding a catalog, and drop the state it kept for the previous one"""
+    config.clients['s3'] = fakes.FakeS3(blobs, args.s3_latency_ms / 1000)
+    config.clients['dynamodb'] = fakes.FakeDynamoDB(items, args.dynamo_latency_ms / 1000)
+    config.clients['ssm'] = fakes.FakeSSM({
+        config.ssm_parameter_names['binaries_bucket_name']: fakes.bucket_name,
+        config.ssm_parameter_names['dynamo_table_name']: fakes.table_name
+    })
+    os.environ[config.environment_variable_names['binaries_bucket_name']] = fakes.bucket_name
+    os.environ[config.environment_variable_names['dynamo_table_name']] = fakes.table_name
+    config.context_provider.reset()
+    handlers.catalog = None
+    handlers.catalog_version_checked_at = float('-inf')
+    handlers.binary_compression_ratios.clear()
+    return handlers.get_context()
+
+
+def drain(body):
+    """Consume a response body the way a server would, returning its size"""
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    if isinstance(body, archive.ArchiveParts):
+        chunks = body.iter_range(0, body.size - 1, handlers.stream_chunk_size)
+    else:
+        chunks = body
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return size
+
+
+def stage_call(stage, ctx, params, payload_type, items, manifest_etag, etag_hit_ratio):
+    """Function making the i-th call of a stage. Package requests present the manifest ETag at the given ratio"""
+    request_params = dict(params, payloadtype=payload_type)
+
+    def find(i):
+        handlers.find_matching_apps(dict(request_params), ctx)
+        return 0
+
+    def build(i):
+        return drain(handlers.build_packages_payload(items, payload_type, set(), ctx, True, args.encoding)[0])
+
+    def handle(i):
+        up_to_date = i % 100 < etag_hit_ratio * 100
+        headers = {'If-None-Match': '"{0}"'.format(manifest_etag)} if up_to_date else {}
+        response = handlers.package_handler(dict(request_params, compression=args.encoding), headers, ctx, stream=True)
+        return drain(response['body'])
+
+    return {'find_matching_apps': find, 'build_packages_payload': build, 'package_handler': handle}[stage]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def measure(call, iterations, concurrency):
+    """Time a cold call, then iterations warm ones, and trace the memory of one more"""
+    started = time.perf_counter()
+    response_bytes = call(0)
+    cold_ms = (time.perf_counter() - started) * 1000
+
+    def timed(i):
+        started = time.perf_counter()
+        call(i)
+        return (time.perf_counter() - started) * 1000
+
+    cpu_started = time.process_time()
+    wall_started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = list(executor.map(timed, range(1, iterations + 1)))
+    else:
+        latencies = [timed(i) for i in range(1, iterations + 1)]
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+
+    tracemalloc.start()
+    try:
+        call(iterations + 1)
+        traced_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'cold_ms': round(cold_ms, 3),
+        'p50_ms': round(percentile(latencies, 0.5), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'throughput_rps': round(iterations / wall, 1),
+        # Process time of every thread, so it includes the fetch and lookup pools
+        'cpu_ms_per_call': round(cpu * 1000 / iterations, 3),
+        'tracemalloc_peak_bytes': traced_peak,
+        # High-water mark of the whole process so far, ru_maxrss is in KiB on Linux
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'response_bytes': response_bytes
+    }
+
+
+def run_scenario(seed, catalog_size, matched, binary_size, payload_type, etag_hit_ratio):
+    items, blobs = fakes.generate_catalog(catalog_size, binary_size, seed)
+    ctx = install_fakes(items, blobs)
+    params = fakes.device_params(matched)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        matched_items, status_code, _ = handlers.find_matching_apps(dict(params, payloadtype=payload_type), ctx)
+        if status_code != 200:
+            raise RuntimeError("Scenario resolved to a {0}: {1}".format(status_code, matched_items))
+        manifest_etag = handlers.manifest_etag(matched_items, payload_type, args.encoding)
+        results = []
+        for stage in stages:
+            call = stage_call(stage, ctx, params, payload_type, matched_items, manifest_etag, etag_hit_ratio)
+            concurrency = args.concurrency if stage == 'package_handler' else 1
+            results.append((stage, measure(call, args.iterations, concurrency)))
+    return results
+
+
+def result_key(record):
+    return json.dumps([record['scenario'], record['stage']], sort_keys=True)
+
+
+def compare(records, baseline_path):
+    """Print the latency ratio of each result to the same scenario and stage of a previous run, return the regressions"""
+    with open(baseline_path) as baseline_file:
+        baseline = {result_key(r): r for r in map(json.loads, baseline_file) if r}
+    regressions = 0
+    for record in records:
+        previous = baseline.get(result_key(record))
+        if not previous:
+            continue
+        ratios = {k: record[k] / previous[k] if previous[k] else 1.0 for k in ('p50_ms', 'p99_ms')}
+        regressed = any(ratio > args.threshold for ratio in ratios.values())
+        regressions += regressed
+        print("{0} {1:<24} p50 x{2:.2f} p99 x{3:.2f} {4}".format(
+            json.dumps(record['scenario'], sort_keys=True), record['stage'], ratios['p50_ms'], ratios['p99_ms'],
+            'REGRESSION' if regressed else ''))
+    return regressions
+
+
+records = []
+scenarios = itertools.product(args.catalog_sizes, args.matched, args.binary_sizes, args.payload_types, args.etag_hit_ratios)
+try:
+    for seed, (catalog_size, matched, binary_size, payload_type, etag_hit_ratio) in enumerate(scenarios, 1):
+        if matched > catalog_size + 1:
+            continue
+        if args.edge and payload_type == 'fullpayload':
+            # Full payloads are refused on Lambda@Edge
+            continue
+        scenario = {
+            'catalog_mode': args.catalog_mode,
+            'catalog_size': catalog_size,
+            'matched': matched,
+            'binary_size': binary_size,
+            'payload_type': payload_type,
+            'encoding': args.encoding,
+            'etag_hit_ratio': etag_hit_ratio,
+            'concurrency': args.concurrency,
+            's3_latency_ms': args.s3_latency_ms,
+            'dynamo_latency_ms': args.dynamo_latency_ms,
+            'edge': args.edge
+        }
+        for stage, result in run_scenario(seed, catalog_size, matched, binary_size, payload_type, etag_hit_ratio):
+            record = {'scenario': scenario, 'stage': stage, 'python': platform.python_version(), 'time': int(time.time()), **result}
+            records.append(record)
+            print("{0} {1:<24} p50 {2:>9.3f}ms p99 {3:>9.3f}ms {4:>8.1f} req/s cpu {5:>8.3f}ms {6:>10} bytes".format(
+                json.dumps({k: scenario[k] for k in ('catalog_size', 'matched', 'binary_size', 'payload_type', 'etag_hit_ratio')}),
+                stage, result['p50_ms'], result['p99_ms'], result['throughput_rps'], result['cpu_ms_per_call'],
+                result['response_bytes']))
+finally:
+    shutil.rmtree(binary_cache_dir, ignore_errors=True)
+
+if args.output:
+    with open(args.output, 'a') as output_file:
+        for record in records:
+            output_file.write(json.dumps(record, sort_keys=True) + "\n")
+if args.compare and compare(records, args.compare):
+    sys.exit(1)
@@ -1,5 +1,8 @@
-from troposphere import GetAtt, Join, Output, Parameter, Ref, Template,If, Equals, Sub, FindInMap
+from troposphere import GetAtt, Join, Output, Parameter, Ref, Template,If, Equals, Not, Sub, FindInMap
 from troposphere.cloudfront import (
+    CacheBehavior,
+    CloudFrontOriginAccessIdentity,
+    CloudFrontOriginAccessIdentityConfig,
     CustomOriginConfig,
     DefaultCacheBehavior,
     Distribution,
@@ -33,8 +36,8 @@ from troposphere.ec2 import (
     NatGateway
 )
 from troposphere.awslambda import Code, Function, Version
-from troposphere.dynamodb import Table, KeySchema, AttributeDefinition
-from troposphere.s3 import Bucket
+from troposphere.dynamodb import Table, KeySchema, AttributeDefinition, GlobalSecondaryIndex, Projection
+from troposphere.s3 import Bucket, BucketPolicy
 from troposphere.apprunner import (
     AuthenticationConfiguration,
     CodeConfigurationValues,
@@ -92,6 +95,20 @@ source_connection_arn = t.add_parameter(Parameter(
     Default="None"
 ))
 
+lambda_code_bucket_param = t.add_parameter(Parameter(
+    "LambdaCodeBucket",
+    Type="String",
+    Description="us-east-1 bucket holding the Lambda@Edge deployment package built by package_lambda.py. Required for EdgeLambda deployments",
+    Default=""
+))
+
+lambda_code_key_param = t.add_parameter(Parameter(
+    "LambdaCodeKey",
+    Type="String",
+    Description="Key of the Lambda@Edge deployment package in LambdaCodeBucket, as printed by package_lambda.py",
+    Default=""
+))
+
 # Conditions
 
 
@@ -110,6 +127,25 @@ t.add_condition(
         "AppRunner"
         ))
 
+# Rules
+
+t.add_rule(
+    "LambdaCodeRequired",
+    {
+        "RuleCondition": Equals(Ref(compute_type_param), "EdgeLambda"),
+        "Assertions": [
+            {
+                "Assert": Not(Equals(Ref(lambda_code_bucket_param), "")),
+                "AssertDescription": "EdgeLambda deployments need LambdaCodeBucket and LambdaCodeKey, see package_lambda.py"
+            },
+            {
+                "Assert": Not(Equals(Ref(lambda_code_key_param), "")),
+                "AssertDescription": "EdgeLambda deployments need LambdaCodeBucket and LambdaCodeKey, see package_lambda.py"
+            }
+        ]
+    }
+)
+
 # Mappings
 t.add_mapping(
     "RoleTrustPolicyMap",
@@ -130,13 +166,26 @@ app_versions_table = t.add_resource(
         "AppVersionsTable",
         AttributeDefinitions=[
             AttributeDefinition(AttributeName="app", AttributeType="S"),
-            AttributeDefinition(AttributeName="env", AttributeType="S")
+            AttributeDefinition(AttributeName="env", AttributeType="S"),
+            AttributeDefinition(AttributeName="attrKey", AttributeType="S")
         ],
         BillingMode="PAY_PER_REQUEST",
         KeySchema=[
             KeySchema(AttributeName="app", KeyType="HASH"),
             KeySchema(AttributeName="env", KeyType="RANGE")
         ],
+        # One flattened row per (item, device attribute), keyed by e.g. "gamer#prod", so attribute matches are
+        # key lookups instead of a scan
+        GlobalSecondaryIndexes=[
+            GlobalSecondaryIndex(
+                IndexName="DeviceAttrIndex",
+                KeySchema=[
+                    KeySchema(AttributeName="attrKey", KeyType="HASH"),
+                    KeySchema(AttributeName="app", KeyType="RANGE")
+                ],
+                Projection=Projection(ProjectionType="ALL")
+            )
+        ],
     )
 )
 
@@ -146,6 +195,38 @@ app_binary_bucket = t.add_resource(
     )
 )
 
+# Lets the /binary/* cache behavior read binaries straight from the bucket when running on Lambda@Edge
+binaries_origin_access_identity = t.add_resource(
+    CloudFrontOriginAccessIdentity(
+        "BinariesOriginAccessIdentity",
+        CloudFrontOriginAccessIdentityConfig=CloudFrontOriginAccessIdentityConfig(
+            Comment="OTA binaries"
+        ),
+        Condition="UseEdgeLambda"
+    )
+)
+
+app_binary_bucket_policy = t.add_resource(
+    BucketPolicy(
+        "AppBinariesPolicy",
+        Bucket=Ref(app_binary_bucket),
+        PolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Action": ["s3:GetObject"],
+                    "Resource": [
+                        Sub("${AppBinaries.Arn}/*")
+                        ],
+                    "Effect": "Allow",
+                    "Principal": {"CanonicalUser": GetAtt(binaries_origin_access_identity, "S3CanonicalUserId")},
+                }
+            ],
+        },
+        Condition="UseEdgeLambda"
+    )
+)
+
 ssm_param_dynamo_table = t.add_resource(
     SSMParameter(
         "DynamoTableNameSSMParam",
@@ -195,6 +276,31 @@ app_execution_role = t.add_resource(
                                 Sub("${AppBinaries.Arn}/*")
                                 ],
                             "Effect": "Allow",
+                        },
+                        # Lets S3 answer NoSuchKey rather than AccessDenied for patches that haven't been generated yet.
+                        # A GetObject carries no s3:prefix, so this can't be narrowed to patches/ with a condition
+                        {
+                            "Action": ["s3:ListBucket"],
+                            "Resource": [
+                                Sub("${AppBinaries.Arn}")
+                                ],
+                            "Effect": "Allow",
+                        },
+                        # Binary patches generated for delta updates are shared between instances through the bucket
+                        {
+                            "Action": ["s3:PutObject"],
+                            "Resource": [
+                                Sub("${AppBinaries.Arn}/patches/*")
+                                ],
+                            "Effect": "Allow",
+                        },
+                        # Request profiles are uploaded to the bucket when PROFILE_S3_PREFIX is set to profiles/
+                        {
+                            "Action": ["s3:PutObject"],
+                            "Resource": [
+                                Sub("${AppBinaries.Arn}/profiles/*")
+                                ],
+                            "Effect": "Allow",
                         }
                     ],
                 },
@@ -205,9 +311,16 @@ app_execution_role = t.add_resource(
                     "Version": "2012-10-17",
                     "Statement": [
                         {
-                            "Action": ["dynamodb:PartiQLSelect"],
+                            "Action": [
+                                "dynamodb:PartiQLSelect",
+                                "dynamodb:Scan",
+                                "dynamodb:GetItem",
+                                "dynamodb:BatchGetItem",
+                                "dynamodb:Query"
+                            ],
                             "Resource": [
-                                Sub("${AppVersionsTable.Arn}")
+                                Sub("${AppVersionsTable.Arn}"),
+                                Sub("${AppVersionsTable.Arn}/index/*")
                                 ],
                             "Effect": "Allow",
                         }
@@ -220,7 +333,7 @@ app_execution_role = t.add_resource(
                     "Version": "2012-10-17",
                     "Statement": [
                         {
-                            "Action": ["ssm:GetParameter"],
+                            "Action": ["ssm:GetParameter", "ssm:GetParameters"],
                             "Resource": [
                                 Sub("arn:aws:ssm:${AWS::Region}:${AWS::AccountId}:parameter/cf-ota-lambda/*")
                                 ],
@@ -251,12 +364,12 @@ app_lambda = t.add_resource(
     Function(
         "AppEdgeLambda",
         Code=Code(
-            S3Bucket="aws-iot-samples-artifacts",
-            S3Key="cf-iot-ota-app.zip"
+            S3Bucket=Ref(lambda_code_bucket_param),
+            S3Key=Ref(lambda_code_key_param)
         ),
-        Handler="app.edgelambda_handler",
+        Handler="edge.edgelambda_handler",
         Role=GetAtt(app_execution_role, "Arn"),
-        Runtime="python3.8",
+        Runtime="python3.12",
         MemorySize=256,
         Timeout=30,
         Condition="UseEdgeLambda"
@@ -287,7 +400,8 @@ source_configuration = SourceConfiguration(
                         BuildCommand="pip install -r runtime/requirements.txt",
                         Port="5000",
                         Runtime="PYTHON_3",
-                        StartCommand="python runtime/app.py",
+                        # Pre-fork gunicorn with threaded workers, configured in runtime/gunicorn.conf.py
+                        StartCommand="gunicorn -c runtime/gunicorn.conf.py",
                         RuntimeEnvironmentVariables=[
                             KeyValuePair(
                                 Name="APP_LOOKUP_TABLE",
@@ -296,6 +410,10 @@ source_configuration = SourceConfiguration(
                             KeyValuePair(
                                 Name="APP_BINARIES_BUCKET",
                                 Value=Ref(app_binary_bucket)
+                            ),
+                            KeyValuePair(
+                                Name="CATALOG_MODE",
+                                Value="snapshot"
                             )
                         ]
                     )
@@ -326,7 +444,8 @@ ota_cf_origin_request_policy = t.add_resource(
            ),
            HeadersConfig=OriginRequestHeadersConfig(
                HeaderBehavior="whitelist",
-               Headers=["If-None-Match"]
+               # X-OTA-Profile reaches the origin without being part of the cache key, see runtime/profiling.py
+               Headers=["If-None-Match", "X-OTA-Profile"]
            ),
            QueryStringsConfig=OriginRequestQueryStringsConfig(
                QueryStringBehavior="all"
@@ -340,13 +459,17 @@ ota_cf_cache_policy = t.add_resource(
         "IoTOTACachePolicy",
         CachePolicyConfig=CachePolicyConfig(
             Name="IoTOTACachePolicy",
+            # The origin picks the TTL of each response with Cache-Control, see runtime/cache_policy.py.
+            # No minimum, so that no-store responses such as load shedding are never cached
             DefaultTTL=30,
-            MaxTTL=100,
-            MinTTL=1,
+            MaxTTL=31536000,
+            MinTTL=0,
             ParametersInCacheKeyAndForwardedToOrigin=ParametersInCacheKeyAndForwardedToOrigin(
                 CookiesConfig=CacheCookiesConfig(
                     CookieBehavior="none"
                 ),
+                # Full payload encoding is picked from the compression query param or, failing that, from whether
+                # the client accepts gzip, so both have to be part of the cache key
                 EnableAcceptEncodingGzip=True,
                 HeadersConfig=CacheHeadersConfig(
                     HeaderBehavior="whitelist",
@@ -360,6 +483,31 @@ ota_cf_cache_policy = t.add_resource(
     )
 )
 
+# Binaries are served from content-addressed /binary/<md5>/<key> URLs, so each one is cached once and kept for a year
+ota_cf_binary_cache_policy = t.add_resource(
+    CachePolicy(
+        "IoTOTABinaryCachePolicy",
+        CachePolicyConfig=CachePolicyConfig(
+            Name="IoTOTABinaryCachePolicy",
+            DefaultTTL=31536000,
+            MaxTTL=31536000,
+            MinTTL=86400,
+            ParametersInCacheKeyAndForwardedToOrigin=ParametersInCacheKeyAndForwardedToOrigin(
+                CookiesConfig=CacheCookiesConfig(
+                    CookieBehavior="none"
+                ),
+                EnableAcceptEncodingGzip=False,
+                HeadersConfig=CacheHeadersConfig(
+                    HeaderBehavior="none"
+                ),
+                QueryStringsConfig=CacheQueryStringsConfig(
+                    QueryStringBehavior="none"
+                )
+            )
+        )
+    )
+)
+
 cloudfront_distribution = t.add_resource(
     Distribution(
         "OTADistribution",
@@ -382,8 +530,48 @@ cloudfront_distribution = t.add_resource(
                             OriginProtocolPolicy="https-only"
                         )
                     ), 
+                no_value),
+                If("UseEdgeLambda", 
+                    Origin(
+                        Id="binaries",
+                        DomainName=GetAtt(app_binary_bucket, "RegionalDomainName"),
+                        S3OriginConfig=S3OriginConfig(
+                            OriginAccessIdentity=Sub("origin-access-identity/cloudfront/${BinariesOriginAccessIdentity}")
+                        )
+                    ), 
                 no_value)
             ],
+            # Lambda@Edge can't return more than 1MB, so on Lambda it only rewrites the path and the bucket serves the binary
+            CacheBehaviors=[
+                CacheBehavior(
+                    PathPattern="/binary/*",
+                    TargetOriginId=If("UseEdgeLambda", "binaries", "1"),
+                    CachePolicyId=Ref(ota_cf_binary_cache_policy),
+                    ViewerProtocolPolicy="allow-all",
+                    LambdaFunctionAssociations=If("UseEdgeLambda", [LambdaFunctionAssociation(
+                        EventType="origin-request",
+                        LambdaFunctionARN=Ref(app_lambda_version)
+                    )], no_value),
+                    CachedMethods=["HEAD", "GET"],
+                    AllowedMethods=["HEAD", "GET"]
+                ),
+                # Batch manifests are POSTed by gateways and answered fresh every time
+                CacheBehavior(
+                    PathPattern="/packages/batch",
+                    TargetOriginId="1",
+                    # Managed CachingDisabled policy
+                    CachePolicyId="4135ea2d-6df8-44a3-9df3-4b5a84be39ad",
+                    ViewerProtocolPolicy="allow-all",
+                    LambdaFunctionAssociations=If("UseEdgeLambda", [LambdaFunctionAssociation(
+                        EventType="origin-request",
+                        LambdaFunctionARN=Ref(app_lambda_version),
+                        IncludeBody=True
+                    )], no_value),
+                    CachedMethods=["HEAD", "GET"],
+                    AllowedMethods=["GET", "HEAD", "OPTIONS", "PUT", "PATCH", "POST", "DELETE"],
+                    OriginRequestPolicyId=Ref(ota_cf_origin_request_policy)
+                )
+            ],
             DefaultCacheBehavior=DefaultCacheBehavior(
                 TargetOriginId="1",
                 CachePolicyId=Ref(ota_cf_cache_policy),
@@ -1,23 +1,40 @@
 import boto3
 import argparse
 import os
-import hashlib
-import base64
+import sys
+from botocore.config import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtime'))
+from cache_policy import invalidate_packages
+from package_lambda import build_lambda_zip, upload_lambda_zip
+from publisher import AwsTarget, DirectoryTarget, generate_catalog, load_manifest, publish, random_binary
 
 parser = argparse.ArgumentParser()
-parser.add_argument('cfn_stack_name')
+parser.add_argument('cfn_stack_name', nargs='?', help="stack to publish to, not needed with --local-dir")
 parser.add_argument('--create', action='store_true')
 parser.add_argument('--profile', default=None)
 parser.add_argument('--compute', default='EdgeLambda')
 parser.add_argument('--source', default='https://github.com/aws-samples/amazon-cloudfront-dynamic-ota')
 parser.add_argument('--sourceauth', default='None')
+parser.add_argument('--code-bucket', help="us-east-1 bucket to upload the edge Lambda's deployment package to, needed to --create an EdgeLambda stack")
+parser.add_argument('--no-invalidate', action='store_true', help="don't invalidate cached package responses after publishing")
+parser.add_argument('--manifest', help="JSON list of catalog items to publish, each with a \"file\" path to its binary")
+parser.add_argument('--synthetic-apps', type=int, help="publish a synthetic catalog of this many apps instead of the sample data")
+parser.add_argument('--synthetic-attributes', type=int, default=10, help="device attributes the synthetic apps are spread over")
+parser.add_argument('--synthetic-envs', type=int, default=2, help="envs each synthetic app is released to")
+parser.add_argument('--binary-size', type=int, default=10485760, help="size of each sample or synthetic binary in bytes")
+parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic catalog")
+parser.add_argument('--local-dir', help="write the binaries and catalog to this directory instead of a stack")
+parser.add_argument('--concurrency', type=int, default=16, help="binaries uploaded in parallel")
 args = parser.parse_args()
 
+if not args.local_dir and not args.cfn_stack_name:
+    parser.error("a stack name is required unless --local-dir is given")
+if args.create and args.compute == 'EdgeLambda' and not args.code_bucket:
+    parser.error("--code-bucket is required to create an EdgeLambda stack")
+
 if args.profile:
     boto3.setup_default_session(profile_name=args.profile)
-cloudformation = boto3.client('cloudformation')
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.resource('s3')
 
 if args.create:
     with open('infrastructure/cloudformation_template.json') as template_file_obj:
@@ -42,6 +59,21 @@ if args.create:
         }
     ]
 
+    if args.compute == 'EdgeLambda':
+        # The function's code is built from this checkout, so it always matches the template
+        code_path = build_lambda_zip('cf-iot-ota-app.zip')
+        code_key = upload_lambda_zip(boto3.client('s3'), code_path, args.code_bucket)
+        template_params += [
+            {
+                'ParameterKey': 'LambdaCodeBucket',
+                'ParameterValue': args.code_bucket
+            },
+            {
+                'ParameterKey': 'LambdaCodeKey',
+                'ParameterValue': code_key
+            }
+        ]
+
 
     stack_create_params = {
         'StackName': args.cfn_stack_name,
@@ -50,6 +82,7 @@ if args.create:
         'Capabilities': ['CAPABILITY_IAM']
     }
 
+    cloudformation = boto3.client('cloudformation')
     create_result = cloudformation.create_stack(**stack_create_params)
     waiter = cloudformation.get_waiter('stack_create_complete')
     print("...waiting for stack to be ready...")
@@ -133,6 +166,24 @@ dynamo_items = [
 ]
 
 
+if args.manifest:
+    entries = load_manifest(args.manifest)
+elif args.synthetic_apps is not None:
+    entries = generate_catalog(args.synthetic_apps, args.synthetic_attributes, args.synthetic_envs, args.binary_size, args.seed)
+else:
+    entries = [(i, random_binary(args.binary_size)) for i in dynamo_items]
+
+if args.local_dir:
+    publish(entries, DirectoryTarget(args.local_dir), args.concurrency)
+    sys.exit(0)
+
+# One connection per parallel upload
+client_config = Config(max_pool_connections=args.concurrency)
+cloudformation = boto3.client('cloudformation')
+dynamodb = boto3.resource('dynamodb', config=client_config)
+s3 = boto3.client('s3', config=client_config)
+cloudfront = boto3.client('cloudfront')
+
 resource_summaries = cloudformation.list_stack_resources(StackName=args.cfn_stack_name).get('StackResourceSummaries')
 
 if not resource_summaries:
@@ -140,22 +191,16 @@ if not resource_summaries:
 
 for r in resource_summaries:
     if r['LogicalResourceId'] == 'AppVersionsTable':
-        dynamo_table = dynamodb.Table(r['PhysicalResourceId'])
+        table_name = r['PhysicalResourceId']
     elif r['LogicalResourceId'] == 'AppBinaries':
-        s3_bucket = s3.Bucket(r['PhysicalResourceId'])
-
-for i in dynamo_items:
-    s3_obj = os.urandom(10485760)
-    s3_obj_hash = hashlib.md5(s3_obj).digest()
-    dynamo_obj_hash = hashlib.md5(s3_obj).hexdigest()
-    content_md5 = base64.b64encode(s3_obj_hash).decode('utf-8')
-    s3_key = '{0}_{1}'.format(i.get('app'), i.get('version'))
-    s3_bucket.put_object(
-        Body=s3_obj,
-        Key=s3_key,
-        ContentMD5=content_md5
-    )
-    i['url'] = "s3://{0}/{1}".format(s3_bucket.name, s3_key)
-    i['md5'] = dynamo_obj_hash
-    dynamo_table.put_item(Item=i)
+        bucket_name = r['PhysicalResourceId']
+    elif r['LogicalResourceId'] == 'OTADistribution':
+        distribution_id = r['PhysicalResourceId']
+
+target = AwsTarget(s3, dynamodb, bucket_name, table_name)
+changed_items = publish(entries, target, args.concurrency)
 
+# CloudFront keeps package responses for a while, so drop the ones the new catalog entries make stale
+if changed_items and not args.no_invalidate:
+    invalidation_id = invalidate_packages(cloudfront, distribution_id, changed_items, target.version)
+    print("Invalidated cached packages of {0} changed catalog entries ({1})".format(len(changed_items), invalidation_id))
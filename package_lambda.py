@@ -0,0 +1,71 @@
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+runtime_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtime')
+
+# Modules only the container uses. The edge Lambda loads edge.py and the request handlers it imports
+container_modules = {'app.py', 'gunicorn.conf.py', 'profiling.py'}
+# Packages the Lambda runtime doesn't provide. boto3 is part of it, and bsdiff4 is left out because patches only go
+# in full payloads, which the edge doesn't serve
+edge_requirements = ['zstandard']
+# Lambda@Edge functions run on x86_64 only
+edge_platform = 'manylinux2014_x86_64'
+# Python version of the function's Runtime in the CloudFormation template
+lambda_python_version = '3.12'
+
+
+def build_lambda_zip(output_path, python_version=lambda_python_version):
+    """Write the edge Lambda's deployment package: the runtime modules and wheels of its dependencies for the Lambda runtime"""
+    build_dir = tempfile.mkdtemp(prefix='ota-lambda-')
+    try:
+        subprocess.run([sys.executable, '-m', 'pip', 'install', '--quiet', '--target', build_dir,
+                        '--platform', edge_platform, '--implementation', 'cp', '--python-version', python_version,
+                        '--only-binary=:all:'] + edge_requirements, check=True)
+        for name in sorted(os.listdir(runtime_dir)):
+            if name.endswith('.py') and name not in container_modules:
+                shutil.copy(os.path.join(runtime_dir, name), build_dir)
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for root, dirs, files in os.walk(build_dir):
+                dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    zip_file.write(path, os.path.relpath(path, build_dir))
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    return output_path
+
+
+def upload_lambda_zip(s3, path, bucket_name, key_prefix='cf-iot-ota-app'):
+    """
+    Upload a deployment package under a key holding its MD5, so that a stack update pointed at a new package
+    always deploys a new function version. Returns the key
+    """
+    with open(path, 'rb') as zip_file:
+        key = '{0}-{1}.zip'.format(key_prefix, hashlib.md5(zip_file.read()).hexdigest())
+    s3.upload_file(path, bucket_name, key)
+    print("Uploaded {0} to s3://{1}/{2}".format(path, bucket_name, key))
+    return key
+
+
+if __name__ == "__main__":
+    import boto3
+
+    parser = argparse.ArgumentParser(description="Build the edge Lambda's deployment package, and upload it for the stack")
+    parser.add_argument('--output', default='cf-iot-ota-app.zip')
+    parser.add_argument('--python-version', default=lambda_python_version)
+    parser.add_argument('--bucket', help="us-east-1 bucket to upload the package to, passed to the stack as LambdaCodeBucket")
+    parser.add_argument('--profile', default=None)
+    args = parser.parse_args()
+
+    build_lambda_zip(args.output, args.python_version)
+    print("Built {0} ({1} bytes)".format(args.output, os.path.getsize(args.output)))
+    if args.bucket:
+        session = boto3.session.Session(profile_name=args.profile)
+        key = upload_lambda_zip(session.client('s3'), args.output, args.bucket)
+        print("Create or update the stack with LambdaCodeBucket={0} LambdaCodeKey={1}".format(args.bucket, key))
@@ -0,0 +1,106 @@
+import boto3
+import argparse
+import collections
+import gzip
+import hashlib
+import base64
+import os
+import sys
+from urllib.parse import parse_qs
+
+parser = argparse.ArgumentParser(description="Build popular full payloads ahead of time and record them in the catalog")
+parser.add_argument('cfn_stack_name')
+parser.add_argument('--params', help="file with one /package query string per line, e.g. cpuArch=armv8&attrGamer=prod")
+parser.add_argument('--access-logs', nargs='*', default=[], help="CloudFront access log files to mine the most requested packages from")
+parser.add_argument('--top', type=int, default=100, help="number of the most requested packages to build from the access logs")
+parser.add_argument('--encodings', nargs='*', default=['gzip'])
+parser.add_argument('--profile', default=None)
+args = parser.parse_args()
+
+if args.profile:
+    boto3.setup_default_session(profile_name=args.profile)
+cloudformation = boto3.client('cloudformation')
+dynamodb = boto3.resource('dynamodb')
+s3 = boto3.resource('s3')
+
+resource_summaries = cloudformation.list_stack_resources(StackName=args.cfn_stack_name).get('StackResourceSummaries')
+
+if not resource_summaries:
+    print("No stack found")
+
+for r in resource_summaries:
+    if r['LogicalResourceId'] == 'AppVersionsTable':
+        dynamo_table = dynamodb.Table(r['PhysicalResourceId'])
+    elif r['LogicalResourceId'] == 'AppBinaries':
+        s3_bucket = s3.Bucket(r['PhysicalResourceId'])
+
+# Packages are built with the application's own code, so they are byte for byte what a request would get
+os.environ['APP_LOOKUP_TABLE'] = dynamo_table.name
+os.environ['APP_BINARIES_BUCKET'] = s3_bucket.name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtime'))
+import handlers
+from catalog import prebuilt_app, prebuilt_env
+
+
+def read_query_strings():
+    query_strings = []
+    if args.params:
+        with open(args.params) as params_file:
+            query_strings += [line.strip() for line in params_file if line.strip()]
+
+    # CloudFront standard logs are tab separated, with the layout given in a #Fields header
+    counts = collections.Counter()
+    for log_path in args.access_logs:
+        opener = gzip.open if log_path.endswith('.gz') else open
+        with opener(log_path, 'rt') as log_file:
+            fields = []
+            for line in log_file:
+                if line.startswith('#Fields:'):
+                    fields = line.split()[1:]
+                    continue
+                if line.startswith('#') or not fields:
+                    continue
+                values = dict(zip(fields, line.rstrip('\n').split('\t')))
+                if values.get('cs-uri-stem') == '/package' and values.get('cs-uri-query', '-') != '-':
+                    counts[values['cs-uri-query']] += 1
+    query_strings += [query_string for query_string, _ in counts.most_common(args.top)]
+    return query_strings
+
+
+archive_extensions = {'gzip': 'tar.gz', 'zstd': 'tar.zst', 'identity': 'tar'}
+
+ctx = handlers.get_context()
+built = set()
+for query_string in read_query_strings():
+    params = {k.lower(): v[0].lower() for k, v in parse_qs(query_string).items()}
+    params.pop('compression', None)
+    request_key = handlers.canonical_params(params)
+    if dict(request_key)['payloadtype'] != 'fullpayload' or request_key in built:
+        continue
+    built.add(request_key)
+
+    items, status_code, _ = handlers.find_matching_apps(params, ctx)
+    if status_code != 200:
+        print("Skipping {0}: {1}".format(query_string, items))
+        continue
+    for encoding in args.encodings:
+        body, _, _ = handlers.build_packages_payload(items, 'fullpayload', set(), ctx, False, encoding)
+        body_md5 = hashlib.md5(body).hexdigest()
+        # Content-addressed, so rebuilding an unchanged package writes the same object again
+        s3_key = 'prebuilt/{0}.{1}'.format(body_md5, archive_extensions[encoding])
+        s3_bucket.put_object(
+            Body=body,
+            Key=s3_key,
+            ContentMD5=base64.b64encode(hashlib.md5(body).digest()).decode('utf-8')
+        )
+        dynamo_table.put_item(Item={
+            'app': prebuilt_app,
+            'env': prebuilt_env(request_key, encoding),
+            'query': query_string,
+            'key': s3_key,
+            'md5': body_md5,
+            'size': len(body),
+            # Only served while the catalog still resolves the request to the same binaries
+            'manifestEtag': handlers.manifest_etag(items, 'fullpayload', encoding)
+        })
+        print("Prebuilt {0} ({1}, {2} bytes) as {3}".format(query_string, encoding, len(body), s3_key))
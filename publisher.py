@@ -0,0 +1,278 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtime'))
+from archive import compressibility_sample_size, compression_ratio
+from cache_policy import binary_cache_control
+from catalog import attribute_index_row, batch_get_max_keys, reserved_app_prefix, version_marker_key
+
+# Number of previous versions of each app kept in the catalog for delta updates
+max_previous_versions = 3
+# Attributes derived from the binary or from earlier publishes. Any other difference changes which devices an item
+# is matched with, or what they are told about it
+derived_attributes = {'url', 'md5', 'size', 'compressionRatio', 'previousVersions'}
+
+
+# PutObject's limit. Binaries are uploaded in a single part, so that their S3 ETag stays their MD5
+max_binary_size = 5368709120
+
+
+class HashingReader:
+    """File object wrapper computing the MD5 and size of what is read through it, and keeping its first bytes"""
+
+    def __init__(self, fileobj, sample_size=compressibility_sample_size):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.sample = b''
+        self.sample_size = sample_size
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        self.size += len(data)
+        if len(self.sample) < self.sample_size:
+            self.sample += data[:self.sample_size - len(self.sample)]
+        return data
+
+
+def binary_key(item):
+    # Binaries are keyed by app and version, so re-uploading the same version overwrites the previous binary
+    return '{0}_{1}'.format(item['app'], item['version'])
+
+
+def catalog_fields(item):
+    return {k: v for k, v in item.items() if k not in derived_attributes}
+
+
+def publish(entries, target, concurrency=16):
+    """
+    Upload the binaries of (item, opener) pairs to a target in parallel, then write their catalog items with the MD5,
+    size and compressibility of the binaries. opener returns a binary file object to read the binary from, and is
+    called twice, so it has to return the same bytes every time.
+    Returns the items that are new, or whose binary or catalog attributes such as deviceAttr changed.
+    """
+    started = time.perf_counter()
+    entries = list(entries)
+
+    def upload(entry):
+        item, opener = entry
+        s3_key = binary_key(item)
+        # The MD5 has to be known before the upload, so each binary is read twice rather than held in memory
+        with opener() as source:
+            reader = HashingReader(source)
+            while reader.read(1048576):
+                pass
+        if reader.size > max_binary_size:
+            raise ValueError("{0} is larger than the {1} bytes a single upload allows".format(s3_key, max_binary_size))
+        with opener() as source:
+            target.upload(s3_key, source, reader.md5.digest())
+        item['url'] = target.url(s3_key)
+        item['md5'] = reader.md5.hexdigest()
+        item['size'] = reader.size
+        # Compressed to original size ratio of the sample, which lets the origin skip compressing binaries that don't shrink
+        item['compressionRatio'] = Decimal(str(round(compression_ratio(reader.sample), 4))) if reader.sample else Decimal(1)
+        return item
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        items = list(executor.map(upload, entries))
+    uploaded_bytes = sum(i['size'] for i in items)
+
+    previous_items = target.get_items([(i['app'], i['env']) for i in items])
+    changed_items = []
+    rows = []
+    stale_keys = []
+    for i in items:
+        previous = previous_items.get((i['app'], i['env']))
+        if not previous or previous.get('md5') != i['md5'] or catalog_fields(previous) != catalog_fields(i):
+            changed_items.append(i)
+        # Keep track of the versions this one replaces, so devices still running them can be sent a patch
+        if previous and previous.get('md5') and previous['version'] != i['version']:
+            i['previousVersions'] = [
+                {'version': previous['version'], 'md5': previous['md5'], 'url': previous['url']}
+            ] + previous.get('previousVersions', [])[:max_previous_versions - 1]
+        elif previous and previous.get('version') == i['version']:
+            i['previousVersions'] = previous.get('previousVersions', [])
+        rows.append(i)
+        # Flattened rows backing the DeviceAttrIndex GSI, one per device attribute
+        for attribute in i.get('deviceAttr', {}):
+            rows.append(attribute_index_row(i, attribute))
+        # and drop the rows of attributes the app is no longer flagged with
+        for attribute in set(previous.get('deviceAttr', {}) if previous else ()) - set(i.get('deviceAttr', {})):
+            stale_keys.append((i['app'], attribute_index_row(previous, attribute)['env']))
+
+    target.write_items(rows, stale_keys)
+    if changed_items:
+        # Lets snapshot mode and the result cache notice the new catalog without waiting for a full refresh
+        target.bump_version()
+    print("Published {0} binaries ({1} bytes, {2} changed) in {3:.1f}s".format(
+        len(items), uploaded_bytes, len(changed_items), time.perf_counter() - started))
+    return changed_items
+
+
+class AwsTarget:
+    """Binaries bucket and versions table of a deployed stack"""
+
+    def __init__(self, s3, dynamodb, bucket_name, table_name):
+        self.s3 = s3
+        self.dynamodb = dynamodb
+        self.bucket_name = bucket_name
+        self.table = dynamodb.Table(table_name)
+        # Catalog version set by the last publish
+        self.version = None
+
+    def url(self, s3_key):
+        return "s3://{0}/{1}".format(self.bucket_name, s3_key)
+
+    def upload(self, s3_key, fileobj, md5):
+        # A single part upload, so the object's ETag is its MD5, which the edge serves /binary/<md5>/<key> with.
+        # S3 rejects the upload if the content doesn't match the MD5
+        self.s3.put_object(
+            Body=fileobj,
+            Bucket=self.bucket_name,
+            Key=s3_key,
+            ContentMD5=base64.b64encode(md5).decode('utf-8'),
+            CacheControl=binary_cache_control()
+        )
+
+    def get_items(self, keys):
+        """Current items by (app, env), fetched in batches"""
+        items = dict()
+        keys = list(dict.fromkeys(keys))
+        for start in range(0, len(keys), batch_get_max_keys):
+            request_items = {self.table.name: {'Keys': [{'app': app, 'env': env} for app, env in keys[start:start + batch_get_max_keys]]}}
+            while request_items:
+                response = self.dynamodb.batch_get_item(RequestItems=request_items)
+                for item in response['Responses'].get(self.table.name, []):
+                    items[(item['app'], item['env'])] = item
+                request_items = response.get('UnprocessedKeys')
+        return items
+
+    def write_items(self, items, stale_keys):
+        # The batch writer sends items 25 at a time and retries the unprocessed ones
+        with self.table.batch_writer(overwrite_by_pkeys=['app', 'env']) as batch:
+            for app, env in stale_keys:
+                batch.delete_item(Key={'app': app, 'env': env})
+            for item in items:
+                batch.put_item(Item=item)
+
+    def bump_version(self):
+        self.version = time.time_ns()
+        self.table.put_item(Item={'app': version_marker_key['app']['S'], 'env': version_marker_key['env']['S'],
+                                  'version': self.version})
+
+
+class DirectoryTarget:
+    """
+    Local stand-in for a stack, needing no AWS account: binaries are written to <directory>/binaries and the catalog to
+    <directory>/catalog.json, which the origin can serve in snapshot mode with CATALOG_FILE
+    """
+
+    def __init__(self, directory, bucket_name='local'):
+        self.directory = directory
+        self.bucket_name = bucket_name
+        self.catalog_path = os.path.join(directory, 'catalog.json')
+        os.makedirs(os.path.join(directory, 'binaries'), exist_ok=True)
+
+    def url(self, s3_key):
+        return "s3://{0}/{1}".format(self.bucket_name, s3_key)
+
+    def upload(self, s3_key, fileobj, md5):
+        with open(os.path.join(self.directory, 'binaries', s3_key), 'wb') as binary_file:
+            shutil.copyfileobj(fileobj, binary_file, 1048576)
+
+    def load_catalog(self):
+        if not os.path.exists(self.catalog_path):
+            return dict()
+        with open(self.catalog_path) as catalog_file:
+            return {(i['app'], i['env']): i for i in json.load(catalog_file)}
+
+    def get_items(self, keys):
+        catalog = self.load_catalog()
+        return {key: catalog[key] for key in keys if key in catalog}
+
+    def write_items(self, items, stale_keys):
+        catalog = self.load_catalog()
+        for key in stale_keys:
+            catalog.pop(key, None)
+        for item in items:
+            catalog[(item['app'], item['env'])] = item
+        # Written aside and renamed, so an origin polling the file never reads half of it
+        with open(self.catalog_path + '.tmp', 'w') as catalog_file:
+            json.dump(list(catalog.values()), catalog_file, indent=1, default=json_default)
+        os.replace(self.catalog_path + '.tmp', self.catalog_path)
+
+    def bump_version(self):
+        # The origin notices a new catalog file by its modification time
+        pass
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError("Cannot serialize {0!r}".format(value))
+
+
+def random_binary(size):
+    # Generated once, as publish() opens each binary twice and both reads must see the same bytes
+    data = os.urandom(size)
+    return lambda: io.BytesIO(data)
+
+
+def load_manifest(path):
+    """
+    (item, opener) pairs of a real catalog described by a JSON file: a list of items, each with a "file" path to its
+    binary, relative to the manifest
+    """
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    entries = []
+    for item in manifest:
+        item = dict(item)
+        file_path = os.path.join(base_dir, item.pop('file'))
+        if item['app'].startswith(reserved_app_prefix):
+            raise ValueError("App names starting with {0} are reserved: {1}".format(reserved_app_prefix, item['app']))
+        entries.append((item, lambda file_path=file_path: open(file_path, 'rb')))
+    return entries
+
+
+def generate_catalog(num_apps, num_attributes, num_envs, binary_size, seed=0, cpu_archs=('armv8', 'armv7'),
+                     random_fraction=0.5):
+    """
+    (item, opener) pairs of a synthetic fleet catalog: an OS image per cpu architecture and num_apps apps, each
+    released to num_envs envs (prod, beta, then env2, env3, ...). Apps are flagged in turn with one of num_attributes
+    device attributes (group0, group1, ...), and every app can also be requested by name (app00000=prod).
+    Binaries are only generated when opened, random_fraction of them random and the rest zeros, so they compress about
+    as well as typical firmware. The same seed always gives the same catalog.
+    """
+    envs = (['prod', 'beta'] + ['env{0}'.format(e) for e in range(2, num_envs)])[:num_envs]
+    random_size = int(binary_size * random_fraction)
+
+    def opener(name):
+        def open_binary():
+            data = random.Random('{0}/{1}'.format(seed, name)).randbytes(random_size)
+            return io.BytesIO(data + bytes(binary_size - random_size))
+        return open_binary
+
+    entries = []
+    for e, env in enumerate(envs):
+        version = '{0}.{1}.0'.format(e + 1, seed)
+        for cpu_arch in cpu_archs:
+            item = {'app': 'os_{0}'.format(cpu_arch), 'env': env, 'version': version, 'cpuArch': cpu_arch}
+            entries.append((item, opener(binary_key(item))))
+        for a in range(num_apps):
+            item = {'app': 'app{0:05d}'.format(a), 'env': env, 'version': version}
+            if num_attributes:
+                item['deviceAttr'] = {'group{0}'.format(a % num_attributes): True}
+            entries.append((item, opener(binary_key(item))))
+    return entries
@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class AdmissionController:
+    """
+    Bounds the bytes that admitted requests may hold at once. A request that doesn't fit waits in a bounded queue
+    for up to queue_timeout seconds, and is rejected when the queue is full or its wait runs out.
+    A request costing more than the whole budget is admitted on its own.
+    """
+
+    def __init__(self, max_bytes, max_queue, queue_timeout):
+        self.max_bytes = max_bytes
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, cost):
+        """Wait for cost bytes of budget. Returns False if the request should be shed instead"""
+        cost = min(cost, self.max_bytes)
+        with self._condition:
+            if self.queued or self.in_flight_bytes + cost > self.max_bytes:
+                if self.queued >= self.max_queue:
+                    self.rejected += 1
+                    return False
+                self.queued += 1
+                try:
+                    deadline = time.monotonic() + self.queue_timeout
+                    while self.in_flight_bytes + cost > self.max_bytes:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.in_flight += 1
+            self.in_flight_bytes += cost
+            self.admitted += 1
+            return True
+
+    def release(self, cost):
+        cost = min(cost, self.max_bytes)
+        with self._condition:
+            self.in_flight -= 1
+            self.in_flight_bytes -= cost
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'in_flight': self.in_flight,
+                'in_flight_bytes': self.in_flight_bytes,
+                'max_bytes': self.max_bytes,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected
+            }
+
+
+class ReleasingBody:
+    """
+    Response body that calls release once the server is done with it, whether it was sent in full or not.
+    WSGI servers call close() on every response body, even one they never iterated.
+    """
+
+    def __init__(self, body, release):
+        self.body = body
+        self._release = release
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        if isinstance(self.body, (bytes, str)):
+            yield self.body
+        else:
+            yield from self.body
+
+    def close(self):
+        with self._lock:
+            released, self._released = self._released, True
+        if released:
+            return
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self._release()
@@ -0,0 +1,175 @@
+import importlib.util
+import itertools
+import os
+import struct
+import tarfile
+import zlib
+
+# Content encodings the package builder can produce. zstd needs the optional zstandard package, which is only
+# imported once a zstd payload is built, to keep it out of cold starts
+available_encodings = ['gzip', 'identity'] + (['zstd'] if importlib.util.find_spec('zstandard') else [])
+# Bumped whenever the same input starts giving different archive bytes, so cached compressed members are rebuilt
+format_version = 2
+# Leading bytes of a binary whose compressibility is measured. The init script records it in the catalog from the same sample
+compressibility_sample_size = int(os.environ.get('COMPRESSIBILITY_SAMPLE_SIZE', 65536))
+
+
+def tar_member_header(name, size):
+    """Build the tar header block(s) for a regular file member, with fixed metadata so archives are reproducible"""
+    tarinfo = tarfile.TarInfo(name=name)
+    tarinfo.size = size
+    tarinfo.mtime = 0
+    tarinfo.mode = 0o644
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    return tarinfo.tobuf(format=tarfile.DEFAULT_FORMAT, encoding=tarfile.ENCODING, errors='surrogateescape')
+
+
+def tar_member_padding(size):
+    """Zero padding required after a member body to reach the next tar block boundary"""
+    remainder = size % tarfile.BLOCKSIZE
+    if remainder:
+        return tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    return b''
+
+
+def tar_end_of_archive():
+    return tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+def iter_tar_member(name, size, chunks):
+    """Yield a single tar member: header, body chunks totalling size bytes and block padding"""
+    yield tar_member_header(name, size)
+    written = 0
+    for chunk in chunks:
+        written += len(chunk)
+        yield chunk
+    if written != size:
+        raise ValueError("Member {0} was {1} bytes, expected {2}".format(name, written, size))
+    yield tar_member_padding(size)
+
+
+def iter_tar(members):
+    """
+    Yield an uncompressed tar stream for the given members.
+    Each member is a (name, size, chunks) tuple where chunks is an iterable of bytes totalling size bytes.
+    """
+    for name, size, chunks in members:
+        yield from iter_tar_member(name, size, chunks)
+    yield tar_end_of_archive()
+
+
+class GzipCompressor:
+    """
+    Streaming gzip member compressor with a fixed header: no mtime, no file name and an unknown OS byte,
+    so the same input always gives the same bytes whichever zlib build or platform compressed it
+    """
+
+    header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+    def __init__(self, level):
+        self._deflate = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._crc = 0
+        self._size = 0
+        self._pending_header = self.header
+
+    def _with_header(self, data):
+        data, self._pending_header = self._pending_header + data, b''
+        return data
+
+    def compress(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        return self._with_header(self._deflate.compress(data))
+
+    def flush(self):
+        return self._with_header(self._deflate.flush()) + struct.pack('<II', self._crc, self._size & 0xffffffff)
+
+
+def compressor(encoding, level):
+    """Streaming compressor with compress()/flush() for a content encoding, or None for identity"""
+    if encoding == 'gzip':
+        return GzipCompressor(level)
+    elif encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return None
+
+
+def iter_compressed(chunks, encoding, level):
+    """Compress an iterable of bytes, yielding compressed chunks as soon as the compressor produces them"""
+    compressobj = compressor(encoding, level)
+    if compressobj is None:
+        yield from chunks
+        return
+    for chunk in chunks:
+        compressed = compressobj.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressobj.flush()
+
+
+def iter_tar_trailer(name, data, encoding, level):
+    """
+    Compressed stream holding a final tar member and the end-of-archive marker.
+    Gzip members and zstd frames that each hold whole tar members can be concatenated byte-for-byte into a
+    valid compressed tar, so this closes an archive whose other members were compressed separately.
+    """
+    tar_chunks = itertools.chain(iter_tar_member(name, len(data), [data]), [tar_end_of_archive()])
+    return iter_compressed(tar_chunks, encoding, level)
+
+
+def compression_ratio(sample):
+    """Compressed to original size ratio of a sample of data, estimated with fast zlib compression"""
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, 1)) / len(sample)
+
+
+def iter_file(fileobj, chunk_size):
+    """Yield the remaining content of a file object in chunk_size reads, closing it once exhausted"""
+    try:
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+class ArchiveParts:
+    """
+    Archive made of byte strings and open files whose sizes are known up front, so its length is known before it
+    is sent and byte ranges can be read from it without assembling it in memory.
+    Parts are either bytes or (size, fileobj) tuples of seekable files.
+    """
+
+    def __init__(self, parts):
+        self.parts = [(len(part), part) if isinstance(part, bytes) else part for part in parts]
+        self.size = sum(size for size, _ in self.parts)
+
+    def iter_range(self, first, last, chunk_size):
+        """Yield bytes first to last (inclusive) of the archive, closing its files once done"""
+        try:
+            offset = 0
+            for size, part in self.parts:
+                start, end = max(first - offset, 0), min(last + 1 - offset, size)
+                offset += size
+                if start >= end:
+                    continue
+                if isinstance(part, bytes):
+                    yield part[start:end]
+                    continue
+                part.seek(start)
+                remaining = end - start
+                while remaining:
+                    chunk = part.read(min(chunk_size, remaining))
+                    if not chunk:
+                        raise ValueError("Archive part is shorter than {0} bytes".format(size))
+                    remaining -= len(chunk)
+                    yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        for _, part in self.parts:
+            if not isinstance(part, bytes):
+                part.close()
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+valid_key_pattern = re.compile(r'[A-Za-z0-9._-]+')
+temp_file_prefix = '.fill-'
+
+
+class BinaryCache:
+    """
+    On-disk, content-addressed cache for binaries with a byte budget and least-recently-used eviction.
+    Entries are keyed by their MD5 (or another content-derived key) and are written to a temporary file
+    before being atomically moved into place, so concurrent readers never see a partial file.
+    Several processes can share the directory: each one picks up the files the others filled,
+    and tolerates files they evicted.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._fill_locks = dict()
+        # key -> [size, verified], ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_existing_entries()
+
+    def _load_existing_entries(self):
+        existing = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.startswith(temp_file_prefix):
+                # Left over from a fill that was interrupted by a previous process
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            existing.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(existing):
+            # Files from a previous process are re-verified the first time they're used
+            self._entries[key] = [size, False]
+            self._total_bytes += size
+        self._evict()
+
+    def _path(self, key):
+        if not valid_key_pattern.fullmatch(key):
+            raise ValueError("Invalid cache key: {0}".format(key))
+        return os.path.join(self.directory, key)
+
+    def _open_cached(self, key, md5):
+        """Open a cached entry and mark it most recently used, or return None if it isn't cached (or is corrupt)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            verified = entry[1]
+        try:
+            fileobj = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            # Evicted by another process sharing the directory
+            self._remove(key)
+            return None
+        if md5 and not verified:
+            if file_md5(fileobj) != md5:
+                print("Discarding corrupt cache entry {0}".format(key))
+                fileobj.close()
+                self._remove(key)
+                return None
+            entry[1] = True
+        return fileobj
+
+    def open(self, key, fill, md5=None):
+        """
+        Return an open binary file object for key, calling fill(fileobj) to populate the entry on a miss.
+        When md5 is given, the filled (or previously persisted) content is checked against it.
+        Concurrent misses for the same key only call fill once.
+        """
+        fileobj = self._open_cached(key, md5)
+        if fileobj:
+            self.hits += 1
+            return fileobj
+
+        with self._lock:
+            fill_lock = self._fill_locks.setdefault(key, threading.Lock())
+        with fill_lock:
+            # Another thread, or another process sharing the directory, may have filled the entry in the meantime
+            fileobj = self._open_cached(key, md5) or self._adopt(key, md5)
+            if fileobj:
+                self.hits += 1
+                return fileobj
+            self.misses += 1
+            try:
+                return self._fill(key, fill, md5)
+            finally:
+                with self._lock:
+                    self._fill_locks.pop(key, None)
+
+    def get(self, key, md5=None):
+        """Return an open file object for key if it is cached, without filling it, or None"""
+        fileobj = self._open_cached(key, md5) or self._adopt(key, md5)
+        if fileobj:
+            self.hits += 1
+        return fileobj
+
+    def _adopt(self, key, md5):
+        """Register and open an entry that another process wrote to the directory"""
+        try:
+            size = os.stat(self._path(key)).st_size
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = [size, False]
+                self._total_bytes += size
+                self._evict(keep=key)
+        return self._open_cached(key, md5)
+
+    def _fill(self, key, fill, md5):
+        path = self._path(key)
+        fd, temp_path = tempfile.mkstemp(prefix=temp_file_prefix, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                writer = HashingWriter(temp_file)
+                fill(writer)
+            if md5 and writer.hexdigest() != md5:
+                raise ValueError("MD5 mismatch for cache entry {0}".format(key))
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        # Opened before the entry is registered so it stays readable even if it is evicted straight away
+        fileobj = open(path, 'rb')
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous:
+                self._total_bytes -= previous[0]
+            self._entries[key] = [writer.size, True]
+            self._total_bytes += writer.size
+            self._evict(keep=key)
+        return fileobj
+
+    def _remove(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._total_bytes -= entry[0]
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self, keep=None):
+        # Unlinking a file that another request still has open is safe, the data goes away once it is closed
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, (size, _) = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            del self._entries[key]
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class HashingWriter:
+    """File wrapper that computes the MD5 and size of everything written through it"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self._md5.update(data)
+        self.size += len(data)
+        return self._fileobj.write(data)
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+def file_md5(fileobj, chunk_size=1048576):
+    md5 = hashlib.md5()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        md5.update(chunk)
+    fileobj.seek(0)
+    return md5.hexdigest()
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+
+# max-age of package and manifest responses, for devices and any cache between them and CloudFront
+max_age = int(os.environ.get('CACHE_MAX_AGE', 100))
+# s-maxage of package and manifest responses, i.e. how long CloudFront keeps them. Publishing a new catalog entry
+# invalidates them, so this can be much longer than devices' poll interval without slowing rollouts down
+edge_max_age = int(os.environ.get('CACHE_EDGE_MAX_AGE', 3600))
+# Per env s-maxage overrides as JSON, e.g. {"beta": 60}. A request covering several envs gets the shortest
+edge_max_age_by_env = json.loads(os.environ.get('CACHE_EDGE_MAX_AGE_BY_ENV', '{}'))
+# How long an expired response may still be served while CloudFront fetches a fresh one in the background
+stale_while_revalidate = int(os.environ.get('CACHE_STALE_WHILE_REVALIDATE_SECONDS', 60))
+# How long an expired response may still be served while the origin is failing
+stale_if_error = int(os.environ.get('CACHE_STALE_IF_ERROR_SECONDS', 86400))
+# max-age of client errors such as unknown profiles or invalid params. They only change when the catalog does
+error_max_age = int(os.environ.get('CACHE_ERROR_MAX_AGE', 600))
+# max-age of single binaries. Their URLs and object keys change whenever their content does, so they never go stale
+binary_max_age = int(os.environ.get('BINARY_MAX_AGE', 31536000))
+
+# Package responses are cached with the query string in the cache key. CloudFront only invalidates the query string
+# variants of a path through a trailing wildcard. Binaries are content-addressed, so they never need invalidating
+package_paths = ['/package*']
+
+
+def cache_control(status_code, envs=()):
+    """Cache-Control header of a response with the given status code, to a request for the given envs"""
+    if status_code >= 500:
+        return 'no-store'
+    if status_code >= 400:
+        return 'max-age={0}'.format(error_max_age)
+    shared_max_age = min([edge_max_age] + [int(edge_max_age_by_env[e]) for e in envs if e in edge_max_age_by_env])
+    directives = ['max-age={0}'.format(min(max_age, shared_max_age)), 's-maxage={0}'.format(shared_max_age)]
+    if stale_while_revalidate:
+        directives.append('stale-while-revalidate={0}'.format(stale_while_revalidate))
+    if stale_if_error:
+        directives.append('stale-if-error={0}'.format(stale_if_error))
+    return ', '.join(directives)
+
+
+def binary_cache_control():
+    """Cache-Control header of single binaries, on the /binary route and on their objects in the bucket"""
+    return 'public, max-age={0}, immutable'.format(binary_max_age)
+
+
+def invalidate_packages(cloudfront, distribution_id, changed_items, catalog_version):
+    """
+    Invalidate the cached package responses of a distribution after the given catalog items changed, in the publish
+    that bumped the catalog to catalog_version. The caller reference is derived from both, so retrying a publish only
+    invalidates once, while rolling back to an earlier catalog invalidates again.
+    Returns the invalidation's id.
+    """
+    digest = hashlib.md5(str(catalog_version).encode('utf-8'))
+    for app, env, md5 in sorted((str(i.get('app')), str(i.get('env')), str(i.get('md5'))) for i in changed_items):
+        digest.update("{0}\0{1}\0{2}\n".format(app, env, md5).encode('utf-8'))
+    response = cloudfront.create_invalidation(
+        DistributionId=distribution_id,
+        InvalidationBatch={
+            'Paths': {'Quantity': len(package_paths), 'Items': package_paths},
+            'CallerReference': digest.hexdigest()
+        }
+    )
+    return response['Invalidation']['Id']
@@ -0,0 +1,282 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from boto3.dynamodb.types import TypeDeserializer
+
+# Items whose app starts with this prefix hold catalog bookkeeping rather than binaries
+reserved_app_prefix = '__'
+version_marker_key = {'app': {'S': '__catalog__'}, 'env': {'S': 'version'}}
+# Full payloads built ahead of time by prebuild.py are recorded under this app, one item per request and encoding
+prebuilt_app = '__prebuilt__'
+
+deserializer = TypeDeserializer()
+
+
+class CatalogSnapshot:
+    """
+    In-memory copy of the app versions catalog, indexed by (app, env) and by (device attribute, env).
+    The snapshot is swapped atomically on refresh, so requests always match against a consistent catalog.
+    A background thread polls a cheap version token and reloads the catalog when it changes,
+    and reloads it unconditionally every refresh_interval seconds.
+    """
+
+    def __init__(self, source, refresh_interval=300, poll_interval=10):
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.poll_interval = poll_interval
+        self.refresh()
+        if poll_interval > 0:
+            threading.Thread(target=self._poll, daemon=True).start()
+
+    def refresh(self):
+        polled_version = self.source.poll_version()
+        version = polled_version
+        items = [
+            i for i in self.source.load_items()
+            if not i['app'].startswith(reserved_app_prefix) and not is_attribute_index_row(i)
+        ]
+
+        items_by_key = dict()
+        items_by_attribute = dict()
+        items_by_md5 = dict()
+        for item in items:
+            items_by_key[(item['app'], item['env'])] = item
+            for attribute, enabled in item.get('deviceAttr', {}).items():
+                if enabled is True:
+                    items_by_attribute.setdefault((attribute, item['env']), []).append(item)
+            if item.get('md5'):
+                items_by_md5[item['md5']] = item
+            # Devices may still be sent to the binaries of the versions an item replaced
+            for previous in item.get('previousVersions', []):
+                items_by_md5.setdefault(previous['md5'], previous)
+
+        if version is None:
+            # Without a version marker, fingerprint the content so a reload that changed nothing keeps the version
+            version = hashlib.md5(json.dumps(items, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        self.indexes = (version, items_by_key, items_by_attribute, items_by_md5)
+        self.polled_version = polled_version
+        self.loaded_at = time.monotonic()
+        print("Loaded catalog version {0} with {1} items".format(version, len(items)))
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                polled_version = self.source.poll_version()
+                due = time.monotonic() - self.loaded_at >= self.refresh_interval
+                if due or polled_version != self.polled_version:
+                    self.refresh()
+            except Exception as e:
+                # Keep serving the previous snapshot, the next poll will try again
+                print("Catalog refresh failed: {0}".format(e))
+
+    @property
+    def version(self):
+        return self.indexes[0]
+
+    def match(self, cpu_arch, os_env, params):
+        """
+        Return the items for a device, with the same semantics as the PartiQL lookup: the OS image for the cpu
+        architecture, plus for each param either the items flagged with a device attribute (attrX=env) or an
+        explicitly requested app (app=env). Items matched by more than one param are only returned once.
+        """
+        _, items_by_key, items_by_attribute, _ = self.indexes
+        matches = dict()
+
+        os_item = items_by_key.get(('os_{0}'.format(cpu_arch), os_env))
+        if os_item:
+            matches[(os_item['app'], os_item['env'])] = os_item
+        for k, v in params.items():
+            if k.startswith('attr'):
+                candidates = items_by_attribute.get((k[4:], v), [])
+            else:
+                candidates = [items_by_key[(k, v)]] if (k, v) in items_by_key else []
+            for item in candidates:
+                matches.setdefault((item['app'], item['env']), item)
+        return list(matches.values())
+
+    def find_by_md5(self, md5):
+        """
+        The item with a binary of this MD5, or the previousVersions entry of the version it replaced, both holding its
+        url. The /binary route uses it to only fetch binaries of the catalog
+        """
+        return self.indexes[3].get(md5)
+
+
+class DynamoCatalogSource:
+    """Loads the catalog with a paginated scan of the app versions table"""
+
+    def __init__(self, dynamodb, table_name):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+
+    def load_items(self):
+        items = []
+        for page in self.dynamodb.get_paginator('scan').paginate(TableName=self.table_name):
+            items.extend({k: deserializer.deserialize(v) for k, v in i.items()} for i in page['Items'])
+        return items
+
+    def poll_version(self):
+        marker = self.dynamodb.get_item(TableName=self.table_name, Key=version_marker_key).get('Item')
+        if marker:
+            return str(deserializer.deserialize(marker['version']))
+        return None
+
+
+class FileCatalogSource:
+    """Loads the catalog from a local JSON file holding a list of items, for testing without DynamoDB"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load_items(self):
+        with open(self.path) as catalog_file:
+            return json.load(catalog_file)
+
+    def poll_version(self):
+        stat = os.stat(self.path)
+        return "{0}-{1}".format(stat.st_mtime_ns, stat.st_size)
+
+
+def prebuilt_env(request_key, encoding):
+    """Sort key of the item recording the prebuilt package of a canonical request in an encoding"""
+    return hashlib.md5(json.dumps([list(request_key), encoding]).encode('utf-8')).hexdigest()
+
+
+def get_prebuilt(dynamodb, table_name, request_key, encoding):
+    """The prebuilt package item of a request, or an empty dict"""
+    key = {'app': {'S': prebuilt_app}, 'env': {'S': prebuilt_env(request_key, encoding)}}
+    item = dynamodb.get_item(TableName=table_name, Key=key).get('Item')
+    return {k: deserializer.deserialize(v) for k, v in item.items()} if item else {}
+
+
+attribute_index_name = 'DeviceAttrIndex'
+batch_get_max_keys = 100
+item_projection = {
+    '#app': 'app', '#env': 'env', '#version': 'version', '#url': 'url', '#md5': 'md5', '#ratio': 'compressionRatio',
+    '#previous': 'previousVersions', '#size': 'size'
+}
+
+
+def attribute_index_key(attribute, env):
+    """Partition key of the DeviceAttrIndex GSI, e.g. gamer#prod"""
+    return "{0}#{1}".format(attribute, env)
+
+
+def attribute_index_row(item, attribute):
+    """
+    Flattened copy of an item for one of its device attributes. A GSI key can only hold a single value, so an item
+    flagged with several attributes gets one row per attribute, keyed under a synthetic env in the base table.
+    """
+    row = {k: v for k, v in item.items() if k != 'deviceAttr'}
+    row['env'] = "{0}#attr#{1}".format(item['env'], attribute)
+    row['attrKey'] = attribute_index_key(attribute, item['env'])
+    return row
+
+
+def is_attribute_index_row(item):
+    return 'attrKey' in item
+
+
+def is_reserved_key(app, env):
+    """Whether an (app, env) key names catalog bookkeeping or a flattened attribute row rather than an app a device can request"""
+    return app.startswith(reserved_app_prefix) or '#attr#' in env
+
+
+def plan_lookups(cpu_arch, os_env, params):
+    """
+    Split a device request into (app, env) primary keys for BatchGetItem and attribute keys for the DeviceAttrIndex GSI,
+    keeping the request order so results can be merged deterministically
+    """
+    plan = []
+    if not is_reserved_key('os_{0}'.format(cpu_arch), os_env):
+        plan.append(('key', ('os_{0}'.format(cpu_arch), os_env)))
+    for k, v in params.items():
+        if k.startswith('attr'):
+            plan.append(('attr', attribute_index_key(k[4:], v)))
+        elif not is_reserved_key(k, v):
+            plan.append(('key', (k, v)))
+    return plan
+
+
+def batch_get_items(dynamodb, table_name, keys):
+    """Fetch items by primary key, retrying unprocessed keys. Returns a dict of (app, env) -> item"""
+    items = dict()
+    request_items = {
+        table_name: {
+            'Keys': [{'app': {'S': app}, 'env': {'S': env}} for app, env in keys],
+            'ProjectionExpression': ', '.join(item_projection),
+            'ExpressionAttributeNames': item_projection
+        }
+    }
+    attempt = 0
+    while request_items:
+        response = dynamodb.batch_get_item(RequestItems=request_items)
+        for i in response['Responses'].get(table_name, []):
+            item = {k: deserializer.deserialize(v) for k, v in i.items()}
+            items[(item['app'], item['env'])] = item
+        request_items = response.get('UnprocessedKeys')
+        if request_items:
+            attempt += 1
+            time.sleep(min(0.05 * 2 ** attempt, 1))
+    return items
+
+
+def query_attribute_index(dynamodb, table_name, attr_key):
+    """Fetch every item flagged with a device attribute for an env, following LastEvaluatedKey"""
+    items = []
+    paginator = dynamodb.get_paginator('query')
+    pages = paginator.paginate(
+        TableName=table_name,
+        IndexName=attribute_index_name,
+        KeyConditionExpression='attrKey = :attrKey',
+        ExpressionAttributeValues={':attrKey': {'S': attr_key}},
+        ProjectionExpression=', '.join(item_projection),
+        ExpressionAttributeNames=item_projection
+    )
+    item_env = attr_key.split('#', 1)[1]
+    for page in pages:
+        for i in page['Items']:
+            item = {k: deserializer.deserialize(v) for k, v in i.items()}
+            # Report the real env rather than the synthetic one of the flattened row
+            item['env'] = item_env
+            items.append(item)
+    return items
+
+
+def lookup_matching_apps_batch(dynamodb, table_name, profiles, executor):
+    """
+    Resolve device requests, given as (cpu_arch, os_env, params) tuples, with key lookups instead of a scan: explicit
+    apps and the OS image through BatchGetItem (100 keys per call), attribute matches through the DeviceAttrIndex GSI,
+    all fanned out in parallel. The keys of all the requests are deduplicated and looked up together.
+    Returns the items of each request, in request order, each once.
+    """
+    plans = [plan_lookups(cpu_arch, os_env, params) for cpu_arch, os_env, params in profiles]
+    keys = list(dict.fromkeys(key for plan in plans for kind, key in plan if kind == 'key'))
+    attr_keys = list(dict.fromkeys(key for plan in plans for kind, key in plan if kind == 'attr'))
+
+    key_lookups = [
+        executor.submit(batch_get_items, dynamodb, table_name, keys[i:i + batch_get_max_keys])
+        for i in range(0, len(keys), batch_get_max_keys)
+    ]
+    attr_lookups = {attr_key: executor.submit(query_attribute_index, dynamodb, table_name, attr_key) for attr_key in attr_keys}
+
+    items_by_key = dict()
+    for lookup in key_lookups:
+        items_by_key.update(lookup.result())
+
+    results = []
+    for plan in plans:
+        matches = dict()
+        for kind, key in plan:
+            if kind == 'key':
+                candidates = [items_by_key[key]] if key in items_by_key else []
+            else:
+                candidates = attr_lookups[key].result()
+            for item in candidates:
+                matches.setdefault((item['app'], item['env']), item)
+        results.append(list(matches.values()))
+    return results
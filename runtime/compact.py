@@ -0,0 +1,67 @@
+import decimal
+import struct
+
+# Compact manifests are CBOR (RFC 8949) maps from app name to an entry keyed by these small integer codes,
+# which encode to a single byte each. The md5 is sent as its raw 16 bytes rather than 32 hex characters
+field_codes = {
+    'latestVersion': 0,
+    'url': 1,
+    'md5': 2,
+    'status_code': 3
+}
+content_type = 'application/cbor'
+
+
+def encode_manifest(package_metadata):
+    """Compact CBOR encoding of a metadata document, as built by metadata_entries"""
+    manifest = dict()
+    for app, entry in package_metadata.items():
+        compact_entry = dict()
+        for field, value in entry.items():
+            if value is None or field not in field_codes:
+                continue
+            if field == 'md5':
+                value = bytes.fromhex(value)
+            compact_entry[field_codes[field]] = value
+        manifest[app] = compact_entry
+    return encode(manifest)
+
+
+def encode(value):
+    """
+    CBOR encoding of None, booleans, integers, strings, bytes, lists and dicts. Map keys are written in the order of
+    their encoded bytes, as deterministic CBOR requires, so the same manifest always gives the same bytes.
+    """
+    if value is None:
+        return b'\xf6'
+    if value is True:
+        return b'\xf5'
+    if value is False:
+        return b'\xf4'
+    if isinstance(value, int):
+        if value >= 0:
+            return _head(0, value)
+        return _head(1, -1 - value)
+    if isinstance(value, bytes):
+        return _head(2, len(value)) + value
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        return _head(3, len(data)) + data
+    if isinstance(value, (list, tuple)):
+        return _head(4, len(value)) + b''.join(encode(v) for v in value)
+    if isinstance(value, dict):
+        pairs = sorted((encode(k), encode(v)) for k, v in value.items())
+        return _head(5, len(pairs)) + b''.join(k + v for k, v in pairs)
+    # Numbers read from DynamoDB are Decimals
+    if isinstance(value, decimal.Decimal) and value == value.to_integral_value():
+        return encode(int(value))
+    raise TypeError("Can't encode {0} as CBOR".format(type(value).__name__))
+
+
+def _head(major_type, argument):
+    if argument < 24:
+        return bytes([major_type << 5 | argument])
+    for additional_info, fmt in ((24, '>B'), (25, '>H'), (26, '>I'), (27, '>Q')):
+        if argument < 1 << (8 * struct.calcsize(fmt)):
+            return bytes([major_type << 5 | additional_info]) + struct.pack(fmt, argument)
+    raise ValueError("CBOR argument too large: {0}".format(argument))
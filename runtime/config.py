@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+import boto3
+from botocore.config import Config
+
+# Lambda@Edge doesn't support environment variables, so it reads its settings from SSM instead
+ssm_parameter_names = {
+    'binaries_bucket_name': '/cf-ota-lambda/APP_BINARIES_BUCKET',
+    'dynamo_table_name': '/cf-ota-lambda/APP_LOOKUP_TABLE'
+}
+environment_variable_names = {
+    'binaries_bucket_name': 'APP_BINARIES_BUCKET',
+    'dynamo_table_name': 'APP_LOOKUP_TABLE'
+}
+
+# Number of threads serving requests in each process, used to size the boto3 connection pools
+worker_threads = int(os.environ.get('WORKER_THREADS', 4))
+# Connections each request may use at once, e.g. for concurrent S3 fetches or Dynamo lookups
+connections_per_request = max(int(os.environ.get('S3_FETCH_CONCURRENCY', 8)), int(os.environ.get('DYNAMO_LOOKUP_CONCURRENCY', 8)))
+client_pool_size = int(os.environ.get('CLIENT_POOL_SIZE', max(10, worker_threads * connections_per_request)))
+settings_ttl_seconds = int(os.environ.get('SETTINGS_TTL_SECONDS', 300))
+
+clients = dict()
+clients_lock = threading.Lock()
+# Session the clients are created from. Sharing it lets the clients after the first reuse the endpoint and retry data
+# it has already loaded, which matters on a cold start needing several of them
+session = None
+
+
+def running_in_lambda():
+    return os.environ.get('AWS_EXECUTION_ENV', "NotLambda").startswith('AWS_Lambda')
+
+
+def get_client(service_name):
+    """Return the process-wide boto3 client for a service. boto3 clients are thread-safe and pool their connections"""
+    client = clients.get(service_name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service_name)
+            if client is None:
+                global session
+                if session is None:
+                    session = boto3.session.Session()
+                client = session.client(service_name, config=Config(max_pool_connections=client_pool_size))
+                clients[service_name] = client
+    return client
+
+
+def reset_clients():
+    """Drop the shared clients, e.g. in a freshly forked worker that must not reuse its parent's connections"""
+    global session
+    with clients_lock:
+        clients.clear()
+        session = None
+
+
+def load_settings():
+    if running_in_lambda():
+        response = get_client('ssm').get_parameters(Names=list(ssm_parameter_names.values()))
+        values = {p['Name']: p['Value'] for p in response['Parameters']}
+        return {k: values.get(name) for k, name in ssm_parameter_names.items()}
+    return {k: os.environ.get(name) for k, name in environment_variable_names.items()}
+
+
+class AppContext:
+    """Request-independent view of the resources a request needs, shared by every request until the settings change"""
+
+    def __init__(self, settings):
+        self.binaries_bucket_name = settings['binaries_bucket_name']
+        self.dynamo_table_name = settings['dynamo_table_name']
+
+    # Clients are created on first use, so the edge Lambda's metadata requests never load the S3 service model
+    @property
+    def s3(self):
+        return get_client('s3')
+
+    @property
+    def dynamodb(self):
+        return get_client('dynamodb')
+
+
+class ContextProvider:
+    """
+    Resolves the settings once per process and caches the resulting AppContext for ttl seconds.
+    Once expired, the cached context keeps being served while a single background thread reloads the settings,
+    so SSM latency or throttling never lands on a request after the first one.
+    """
+
+    def __init__(self, loader=load_settings, ttl=settings_ttl_seconds):
+        self.loader = loader
+        self.ttl = ttl
+        self._context = None
+        self._expires_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._context is None:
+            with self._lock:
+                if self._context is None:
+                    self._load()
+        elif time.monotonic() >= self._expires_at:
+            with self._lock:
+                start_refresh = not self._refreshing
+                self._refreshing = True
+            if start_refresh:
+                threading.Thread(target=self._refresh, daemon=True).start()
+        return self._context
+
+    def _load(self):
+        settings = self.loader()
+        if self._context is None or settings != self._settings:
+            self._context = AppContext(settings)
+            self._settings = settings
+        self._expires_at = time.monotonic() + self.ttl
+
+    def _refresh(self):
+        try:
+            self._load()
+        except Exception as e:
+            # Keep serving the cached context, the next expired request will try again
+            print("Settings refresh failed: {0}".format(e))
+            self._expires_at = time.monotonic() + min(self.ttl, 30)
+        finally:
+            self._refreshing = False
+
+    def reset(self):
+        with self._lock:
+            self._context = None
+
+
+context_provider = ContextProvider()
+
+
+def get_context():
+    return context_provider.get()
@@ -0,0 +1,33 @@
+import importlib.util
+
+# Binary patches need the optional bsdiff4 package, devices apply them with bspatch. It is only imported when a patch
+# is generated, so that cold starts that never generate one don't pay for it
+patch_format = 'bsdiff4'
+available = importlib.util.find_spec('bsdiff4') is not None
+
+
+def find_base(item, etags):
+    """The entry of an item's previousVersions whose MD5 the device presented, i.e. the version it has installed"""
+    for previous in item.get('previousVersions') or []:
+        if previous.get('md5') in etags:
+            return previous
+    return None
+
+
+def known_md5s(items):
+    """MD5s of the latest and previous versions of the given items"""
+    md5s = set()
+    for item in items:
+        md5s.add(item.get('md5'))
+        md5s.update(previous.get('md5') for previous in item.get('previousVersions') or [])
+    return md5s
+
+
+def patch_key(base_md5, target_md5):
+    """Content address of the patch between two binaries"""
+    return "{0}-{1}.{2}".format(base_md5, target_md5, patch_format)
+
+
+def diff(base, target):
+    import bsdiff4
+    return bsdiff4.diff(base, target)
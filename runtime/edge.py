@@ -0,0 +1,75 @@
+import base64
+from urllib.parse import parse_qs
+import telemetry
+from config import get_context
+from handlers import (batch_handler, binary_path_pattern, binary_path_prefix, create_error_response,
+                      create_http_response, get_measured_context, package_handler)
+
+# Lambda@Edge entry point. It only imports the request handlers, not Flask or the profiler, to keep cold starts short
+
+
+def edgelambda_handler(event, _):
+    print("Received")
+
+    request = event['Records'][0]['cf']['request']
+    if request['uri'].startswith(binary_path_prefix):
+        return binary_origin_request(request)
+    if request['uri'] == '/packages/batch' and request.get('method') == 'POST':
+        # The origin request only carries the body when the Lambda association includes it
+        body = request.get('body', {})
+        if body.get('inputTruncated'):
+            # CloudFront only passes the first 1MB of a body to the Lambda
+            return create_edge_response(create_error_response(413, "Batch request body too large"))
+        data = body.get('data', '')
+        if body.get('encoding') == 'base64':
+            data = base64.b64decode(data)
+        return create_edge_response(batch_handler(data, get_context()))
+
+    query_string = request.get('querystring')
+    if not query_string:
+        return create_edge_response(create_http_response('No query params provided', 400))
+
+    params = {k.lower(): v[0].lower() for k, v in parse_qs(query_string).items()}
+    headers = {v[0]['key']: v[0]['value'] for v in request['headers'].values()}
+
+    response = telemetry.measure(
+        lambda: package_handler(params, headers, get_measured_context(), head=request.get('method') == 'HEAD'))
+
+    return create_edge_response(response)
+
+
+def create_edge_response(response):
+    """Reformat a response for CloudFront, which wants lowercased header names mapping to lists of key/value pairs"""
+    reformatted_headers = dict()
+    for k, v in response['headers'].items():
+        reformatted_headers[k.lower()] = [
+                {
+                     'key': k,
+                     'value': v
+                 }
+            ]
+    new_response = dict()
+    new_response['headers'] = reformatted_headers
+    new_response['status'] = response['status_code']
+    new_response['body'] = response['body']
+    if isinstance(response['body'], bytes):
+        # Lambda@Edge bodies are text, so binary ones are sent base64 encoded
+        new_response['body'] = base64.b64encode(response['body']).decode('utf-8')
+        new_response['bodyEncoding'] = 'base64'
+
+    return new_response
+
+
+def binary_origin_request(request):
+    """
+    Point a /binary/<md5>/<s3 key> request of the edge Lambda at the object in the binaries bucket.
+    The cache behavior for that path uses the bucket as its origin, so large binaries never pass through the Lambda.
+    The request is made conditional on the MD5, which S3 answers with a 412 if the object's content is not that binary.
+    """
+    match = binary_path_pattern.fullmatch(request['uri'])
+    if not match:
+        return create_edge_response(create_error_response(404, "Binary not found"))
+    request['uri'] = '/' + match.group(2)
+    request['querystring'] = ''
+    request['headers']['if-match'] = [{'key': 'If-Match', 'value': '"{0}"'.format(match.group(1))}]
+    return request
@@ -0,0 +1,40 @@
+import multiprocessing
+import os
+
+# Production server for the container: gunicorn -c runtime/gunicorn.conf.py
+chdir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = 'app:flapp'
+bind = '0.0.0.0:{0}'.format(os.environ.get('PORT', 5000))
+
+# One process per core, each serving requests on a pool of threads. Requests mostly wait on S3 and DynamoDB,
+# so threads keep a process busy while the processes spread compression over every core
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Tells the workers how many of them share the host, so they split the admission and binary cache budgets between them
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = 'gthread'
+# Also sizes the connection pools of the shared boto3 clients in config.py
+threads = int(os.environ.get('WORKER_THREADS', 4))
+keepalive = int(os.environ.get('KEEPALIVE_SECONDS', 5))
+# Full payloads can take a while to stream to slow devices
+timeout = int(os.environ.get('WORKER_TIMEOUT_SECONDS', 120))
+# Time given to in-flight requests to finish on shutdown or redeploy
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT_SECONDS', 30))
+# Restart workers now and then to bound the growth of the in-process caches. 0 disables it
+max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    # Each worker builds its own boto3 clients and connections rather than sharing sockets with its siblings
+    import config
+    config.reset_clients()
+    config.context_provider.reset()
+
+
+def post_worker_init(worker):
+    import handlers
+    if handlers.catalog_mode == 'snapshot':
+        # Load the catalog before the worker serves traffic rather than on its first request
+        handlers.get_catalog(handlers.get_context())
@@ -0,0 +1,1134 @@
+import decimal
+import json
+import hashlib
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+import re
+import io
+import os
+import shutil
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import archive
+import cache_policy
+import compact
+import delta
+import telemetry
+from admission import AdmissionController, ReleasingBody
+from binary_cache import BinaryCache
+from catalog import CatalogSnapshot, DynamoCatalogSource, FileCatalogSource, get_prebuilt, is_reserved_key, lookup_matching_apps_batch
+from config import get_context, running_in_lambda
+from result_cache import ResultCache
+from singleflight import SingleFlight
+
+deserializer = TypeDeserializer()
+
+# Maximum number of binaries downloaded from S3 in parallel for a single full payload request
+s3_fetch_concurrency = int(os.environ.get('S3_FETCH_CONCURRENCY', 8))
+# Size of the chunks read from S3 and fed to the compressor when assembling a full payload
+stream_chunk_size = int(os.environ.get('STREAM_CHUNK_SIZE', 65536))
+
+# Processes serving requests on the host and sharing its memory and disk. gunicorn.conf.py sets it for its workers
+worker_processes = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+
+# Local content-addressed cache of binaries keyed by MD5. Lambda only allows writes to /tmp
+binary_cache_dir = os.environ.get('BINARY_CACHE_DIR', '/tmp/ota-binary-cache')
+# Budget of the cache directory, which all the processes of the host share. Each one evicts the entries it uses
+# down to an even share of it, so together they stay within the budget
+binary_cache_max_bytes = int(os.environ.get('BINARY_CACHE_MAX_BYTES', 1073741824))
+# Lambda never builds full payloads, so it doesn't scan the cache directory on a cold start
+if binary_cache_max_bytes > 0 and not running_in_lambda():
+    binary_cache = BinaryCache(binary_cache_dir, max(1, binary_cache_max_bytes // worker_processes))
+else:
+    binary_cache = None
+
+# Compress each binary's tar member once, keep it in the binary cache and concatenate the cached gzip members per request
+precompressed_members = os.environ.get('PRECOMPRESSED_MEMBERS', 'true').lower() == 'true'
+gzip_compresslevel = int(os.environ.get('GZIP_COMPRESSLEVEL', 9))
+zstd_compresslevel = int(os.environ.get('ZSTD_COMPRESSLEVEL', 3))
+# Binaries whose sample compresses by less than this fraction are stored without compression
+compression_min_savings = float(os.environ.get('COMPRESSION_MIN_SAVINGS', 0.05))
+# Compressed to original size ratio per binary MD5, from the catalog or measured on first use
+binary_compression_ratios = dict()
+compression_levels = {'gzip': gzip_compresslevel, 'zstd': zstd_compresslevel}
+# gzip level 0 writes stored deflate blocks, and zstd falls back to raw blocks on its own at its fastest level
+store_compression_levels = {'gzip': 0, 'zstd': 1}
+tar_payload_types = {'gzip': 'tar', 'zstd': 'tar_zstd', 'identity': 'tar_identity'}
+compact_payload_types = {'gzip': 'cbor_gzip', 'zstd': 'cbor_zstd', 'identity': 'cbor'}
+
+# Send a patch instead of the full binary when a device presents the MD5 of a previous version. Patches are kept in
+# the binary cache, so delta updates need it enabled
+delta_updates = os.environ.get('DELTA_UPDATES', 'true').lower() == 'true' and delta.available
+# Patches larger than this fraction of the full binary aren't worth sending
+delta_max_ratio = float(os.environ.get('DELTA_MAX_RATIO', 0.5))
+# Memory generating a patch takes, as a multiple of the target binary's size: both binaries plus bsdiff's suffix array
+patch_memory_factor = int(os.environ.get('PATCH_MEMORY_FACTOR', 18))
+# Patches are generated in the background, off the request path, by this many threads
+patch_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('PATCH_GENERATION_CONCURRENCY', 1)))
+patches_in_progress = set()
+patches_lock = threading.Lock()
+# Generated patches are also stored in the binaries bucket under this prefix, for other instances. Empty disables it
+patch_bucket_prefix = os.environ.get('PATCH_BUCKET_PREFIX', 'patches/')
+
+# 'keys' resolves matching apps with key lookups on the table and the DeviceAttrIndex GSI, 'query' with a PartiQL
+# statement, and 'snapshot' matches against an in-memory copy of the catalog
+catalog_mode = os.environ.get('CATALOG_MODE', 'keys')
+# Shared pool used to fan out the Dynamo lookups of a request
+lookup_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('DYNAMO_LOOKUP_CONCURRENCY', 8)))
+# Optional local JSON catalog used instead of the Dynamo table in snapshot mode
+catalog_file = os.environ.get('CATALOG_FILE')
+catalog_refresh_seconds = int(os.environ.get('CATALOG_REFRESH_SECONDS', 300))
+catalog_poll_seconds = int(os.environ.get('CATALOG_POLL_SECONDS', 10))
+catalog = None
+catalog_lock = threading.Lock()
+catalog_version = None
+catalog_version_checked_at = float('-inf')
+
+# In-process cache of resolved item lists and rendered metadata, keyed by the canonical request params
+result_cache_max_entries = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 10000))
+result_cache_ttl_seconds = int(os.environ.get('RESULT_CACHE_TTL_SECONDS', 60))
+if result_cache_max_entries > 0 and result_cache_ttl_seconds > 0:
+    result_cache = ResultCache(result_cache_max_entries, result_cache_ttl_seconds)
+else:
+    result_cache = None
+# Serve the full payloads that prebuild.py built ahead of time, as long as they match the current catalog
+prebuilt_packages = os.environ.get('PREBUILT_PACKAGES', 'true').lower() == 'true'
+
+# Bytes that full payload builds of all the processes of the host may hold at once, estimated from the size of the
+# binaries they send. Each process gets an even share of it. Requests over a process's budget wait in a bounded queue,
+# then are shed with a 503. 0 disables admission control
+admission_max_bytes = int(os.environ.get('ADMISSION_MAX_BYTES', 1073741824))
+admission_max_queue = int(os.environ.get('ADMISSION_MAX_QUEUE', 32))
+admission_queue_seconds = float(os.environ.get('ADMISSION_QUEUE_SECONDS', 5))
+admission_retry_after_seconds = int(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', 5))
+# Cost assumed for binaries whose catalog item doesn't record their size
+default_binary_size = int(os.environ.get('DEFAULT_BINARY_SIZE', 10485760))
+if admission_max_bytes > 0:
+    admission = AdmissionController(max(1, admission_max_bytes // worker_processes), admission_max_queue, admission_queue_seconds)
+else:
+    admission = None
+
+# Identical concurrent requests, e.g. a fleet missing CloudFront right after a release, share one lookup and build
+package_flights = SingleFlight()
+
+# Maximum number of devices a gateway may resolve in a single /packages/batch request
+batch_max_devices = int(os.environ.get('BATCH_MAX_DEVICES', 1000))
+
+# Single binaries are served at /binary/<md5>/<s3 key>. The path changes whenever the content does, so it can be cached for good
+binary_path_prefix = '/binary/'
+binary_path_pattern = re.compile(r'/binary/([0-9a-f]{32})/([^/]+)')
+
+def get_measured_context():
+    # Reads the settings from SSM on Lambda@Edge, the first time and then whenever they are due for a refresh
+    with telemetry.stage('settings'):
+        return get_context()
+
+
+def package_handler(params, headers, ctx, stream=False, head=False):
+    etags = parse_etags(headers.get('If-None-Match'))
+
+    compression_param = params.pop('compression', None)
+    encoding = select_encoding(compression_param, headers.get('Accept-Encoding'))
+    if params.get('payloadtype') == 'compact' and not compression_param:
+        # Inflating needs a window of up to 32KB that small devices may not have, so compact manifests are
+        # only compressed when the compression param asks for it
+        encoding = 'identity'
+    # Equivalent spellings of the same request share lookups and builds
+    request_key = canonical_params(params)
+    if not encoding:
+        query_results, status_code, payload_type_param = "Unsupported compression param", 400, "json"
+    else:
+        with telemetry.stage('resolve'):
+            if result_cache:
+                result_cache.check_version(get_catalog_version(ctx))
+            query_results, status_code, payload_type_param = resolve_once(
+                ('items', request_key), lambda: find_matching_apps(params, ctx))
+
+    etag = None
+    admitted_cost = None
+    if status_code != 200:
+        body = query_results
+        payload_type = payload_type_param
+    else:
+        # What gets built only depends on which of the resolved binaries, or their previous versions, the client already has
+        current_md5s = frozenset(etags & delta.known_md5s(query_results))
+        # Devices that are up to date present the manifest ETag and get a 304 without any S3 or archive work
+        manifest = manifest_etag(query_results, payload_type_param, encoding)
+        etag = response_etag(manifest, current_md5s)
+        telemetry.set_dimension('PayloadType', payload_type_param)
+        telemetry.count('etag_hits', len(etags & (current_md5s | {manifest, etag})))
+        if manifest in etags or etag in etags or '*' in etags:
+            return create_not_modified_response(etag, request_envs(request_key))
+        if payload_type_param == "fullpayload" and not has_binaries_to_fetch(query_results, etags):
+            # The client already has every binary, so a GET would build nothing and a HEAD gets the same 304
+            return create_not_modified_response(etag, request_envs(request_key))
+        patch_bases = None
+        if payload_type_param == "fullpayload" and current_md5s:
+            # Whether a patch is sent depends on which patches are ready, so the bytes, and the ETag, do too
+            with telemetry.stage('patches'):
+                patch_bases = choose_patch_bases(ctx, query_results, etags)
+            etag = response_etag(manifest, current_md5s, patch_bases)
+            if etag in etags:
+                return create_not_modified_response(etag, request_envs(request_key))
+
+        build = lambda: build_packages_payload(query_results, payload_type_param, etags, ctx, stream, encoding, patch_bases)
+        prebuilt = None
+        if payload_type_param == "fullpayload" and not current_md5s:
+            with telemetry.stage('prebuilt'):
+                prebuilt = find_prebuilt(ctx, request_key, encoding, manifest)
+            if prebuilt:
+                # A prebuilt package can differ from the archive built on demand, so it has an ETag of its own bytes.
+                # The manifest ETag checked above still gets a 304, as both hold the same binaries
+                etag = prebuilt['md5']
+                if etag in etags:
+                    return create_not_modified_response(etag, request_envs(request_key))
+        if head and payload_type_param == "fullpayload":
+            return create_payload_head_response(etag, request_envs(request_key), encoding, prebuilt, stream)
+        if payload_type_param == "metadataonly":
+            with telemetry.stage('build'):
+                body, status_code, payload_type = resolve_once(('metadata', request_key, current_md5s), build)
+        elif payload_type_param == "compact":
+            with telemetry.stage('build'):
+                body, status_code, payload_type = resolve_once(('metadata', request_key, current_md5s, encoding), build)
+        elif prebuilt:
+            # A prebuilt package is a single cached file, so it is served without assembly or admission
+            with telemetry.stage('build'):
+                body, status_code, payload_type = open_prebuilt(ctx, prebuilt, stream), 200, tar_payload_types[encoding]
+        else:
+            cost = payload_cost(query_results, etags)
+            if admission:
+                with telemetry.stage('admission'):
+                    admitted = admission.acquire(cost)
+                if not admitted:
+                    return create_overloaded_response()
+                admitted_cost = cost
+            try:
+                with telemetry.stage('build'):
+                    if stream:
+                        # A stream can't be shared between requests, but the S3 downloads and compression behind it
+                        # are coalesced per binary by the binary cache
+                        body, status_code, payload_type = build()
+                    else:
+                        patches = frozenset(delta.patch_key(base['md5'], md5) for md5, base in (patch_bases or {}).items())
+                        body, status_code, payload_type = resolve_once(('payload', request_key, current_md5s, patches, encoding), build, cache=False)
+            except BaseException:
+                if admitted_cost is not None:
+                    admission.release(admitted_cost)
+                raise
+    response = create_http_response(body, status_code, payload_type, etag)
+    response['headers']['Cache-Control'] = cache_policy.cache_control(status_code, request_envs(request_key))
+    if status_code == 200 and payload_type in tar_payload_types.values():
+        response = apply_range(response, headers)
+
+    if admitted_cost is not None:
+        if response['status_code'] in (200, 206):
+            # The budget is held until the payload has been sent, or the client went away
+            response['body'] = ReleasingBody(response['body'], lambda: admission.release(admitted_cost))
+        else:
+            admission.release(admitted_cost)
+    return response
+        
+
+def batch_handler(data, ctx):
+    """
+    Resolve the metadata of many devices at once, for gateways fronting them. The request body is
+    {"devices": [{"id": ..., "params": {"cpuArch": ..., ...}, "etags": [...]}, ...]}. Devices with the same params
+    share one resolution, and all profiles missing from the result cache are resolved together.
+    The response has a metadata document per device, in request order, and a table of the binaries they reference.
+    """
+    try:
+        devices = json.loads(data)['devices']
+        if not isinstance(devices, list):
+            raise ValueError("devices must be a list")
+        device_params = [{k.lower(): str(v).lower() for k, v in device.get('params', {}).items()} for device in devices]
+        device_etags = []
+        for device in devices:
+            etags = device.get('etags', [])
+            if not isinstance(etags, list) or not all(isinstance(etag, str) for etag in etags):
+                raise ValueError("etags must be a list of strings")
+            device_etags.append(parse_etags(','.join(etags)))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return create_error_response(400, "Invalid batch request: {0}".format(e))
+    if len(devices) > batch_max_devices:
+        return create_error_response(413, "At most {0} devices per batch".format(batch_max_devices))
+
+    for params in device_params:
+        params.pop('compression', None)
+        params['payloadtype'] = 'metadataonly'
+    request_keys = [canonical_params(params) for params in device_params]
+
+    if result_cache:
+        result_cache.check_version(get_catalog_version(ctx))
+    resolved = dict()
+    for request_key in request_keys:
+        cached = result_cache.get(('items', request_key)) if result_cache and request_key not in resolved else None
+        if cached:
+            resolved[request_key] = cached
+    missing = list(dict.fromkeys(k for k in request_keys if k not in resolved))
+    results = find_matching_apps_batch([dict(k) for k in missing], ctx) if missing else []
+    for request_key, result in zip(missing, results):
+        resolved[request_key] = result
+        if result_cache:
+            result_cache.put(('items', request_key), result)
+
+    binaries = dict()
+    documents = []
+    for device, request_key, etags in zip(devices, request_keys, device_etags):
+        items, status_code, _ = resolved[request_key]
+        document = {'id': device.get('id'), 'status_code': status_code}
+        if status_code != 200:
+            document['error'] = items
+            documents.append(document)
+            continue
+        etag = response_etag(manifest_etag(items, 'metadataonly', None), frozenset(etags & delta.known_md5s(items)))
+        document['etag'] = etag
+        packages = metadata_entries(items, etags)
+        if etag in etags or not any(entry['status_code'] == 200 for entry in packages.values()):
+            document['status_code'] = 304
+        else:
+            document['packages'] = {
+                app: {k: v for k, v in entry.items() if k != 'url'} for app, entry in packages.items()
+            }
+            for item in items:
+                binaries.setdefault(item.get('md5'), {
+                    'app': item.get('app'),
+                    'version': item.get('version'),
+                    'url': download_url(item),
+                    'size': item.get('size')
+                })
+        documents.append(document)
+
+    body = json.dumps({'devices': documents, 'binaries': binaries}, sort_keys=True, default=json_default)
+    response = create_http_response(body, 200, 'json')
+    response['headers']['Cache-Control'] = 'no-store'
+    return response
+
+
+def json_default(value):
+    # Numbers read from DynamoDB are Decimals
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError("Cannot serialize {0!r}".format(value))
+
+
+def binary_handler(md5, s3_key, headers, ctx):
+    """
+    Serve a single binary by MD5 with a strong ETag. Its URL is content-addressed, so it is cacheable forever.
+    The content is checked against the MD5 in the URL before (binary cache) or while (streaming) it is sent.
+    """
+    if not binary_path_pattern.fullmatch(binary_path(md5, s3_key)):
+        return create_error_response(404, "Binary not found")
+
+    binary_headers = {
+        'Cache-Control': cache_policy.binary_cache_control(),
+        'ETag': '"{0}"'.format(md5)
+    }
+    if md5 in parse_etags(headers.get('If-None-Match')):
+        return {'status_code': 304, 'headers': binary_headers, 'body': b''}
+
+    if catalog_mode == 'snapshot':
+        # Only binaries the catalog lists, current or previous versions, are fetched
+        entry = get_catalog(ctx).find_by_md5(md5)
+        if not entry or download_url(entry) != binary_path(md5, s3_key):
+            return create_error_response(404, "Binary not found")
+
+    try:
+        # The fetch is conditional on the MD5, so S3 refuses it rather than sending an object with other content
+        if binary_cache:
+            def fill(fileobj):
+                shutil.copyfileobj(get_s3_object(ctx, s3_key, md5)['Body'], fileobj, stream_chunk_size)
+            fileobj = binary_cache.open(md5, fill, md5)
+            size = os.fstat(fileobj.fileno()).st_size
+            chunks = archive.iter_file(fileobj, stream_chunk_size)
+        else:
+            s3_object = get_s3_object(ctx, s3_key, md5)
+            size = s3_object['ContentLength']
+            chunks = iter_verified(archive.iter_file(s3_object['Body'], stream_chunk_size), md5, s3_key)
+    except ClientError as e:
+        print("Binary {0} unavailable: {1}".format(s3_key, e))
+        # Only a missing object, or one with other content, is a 404. Throttling or S3 errors must not be cached as one
+        if e.response['Error']['Code'] in ('NoSuchKey', 'PreconditionFailed', '404', '412'):
+            return create_error_response(404, "Binary not found")
+        return create_error_response(502, "Binary unavailable, please retry later")
+    except Exception as e:
+        print("Binary {0} unavailable: {1}".format(s3_key, e))
+        return create_error_response(502, "Binary unavailable, please retry later")
+
+    return {
+        'status_code': 200,
+        'headers': {
+            **binary_headers,
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': str(size),
+            'Content-Disposition': 'attachment; filename="{0}"'.format(s3_key)
+        },
+        'body': chunks
+    }
+
+
+def iter_verified(chunks, md5, name):
+    """Pass chunks through, raising at the end if their MD5 doesn't match, so the response is cut short rather than cached"""
+    body_md5 = hashlib.md5()
+    for chunk in chunks:
+        body_md5.update(chunk)
+        yield chunk
+    if body_md5.hexdigest() != md5:
+        raise ValueError("MD5 mismatch for {0}".format(name))
+
+
+def parse_etags(if_none_match):
+    """Set of the entity tags in an If-None-Match header, without quotes or weak validator prefixes"""
+    etags = set()
+    for etag in (if_none_match or '').split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        etag = etag.strip('"')
+        if etag:
+            etags.add(etag)
+    return etags
+
+
+def manifest_etag(items, payload_type, encoding):
+    """
+    Strong ETag of a resolved manifest: a digest of each item's app, version and MD5, in a fixed order, and of the
+    response format. It only changes when a device would get something different.
+    """
+    digest = hashlib.md5()
+    for app, version, md5 in sorted((str(i.get('app')), str(i.get('version')), str(i.get('md5'))) for i in items):
+        digest.update("{0}\0{1}\0{2}\n".format(app, version, md5).encode('utf-8'))
+    digest.update("{0}\0{1}".format(payload_type, encoding if payload_type in ('fullpayload', 'compact') else '').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def find_prebuilt(ctx, request_key, encoding, manifest):
+    """The package prebuilt for a request, provided it was built from the same manifest as the current one"""
+    if not prebuilt_packages or catalog_file:
+        return None
+    try:
+        prebuilt = resolve_once(
+            ('prebuilt', request_key, encoding), lambda: get_prebuilt(ctx.dynamodb, ctx.dynamo_table_name, request_key, encoding))
+    except Exception as e:
+        print("Prebuilt package lookup failed: {0}".format(e))
+        return None
+    return prebuilt if prebuilt.get('manifestEtag') == manifest else None
+
+
+def open_prebuilt(ctx, prebuilt, stream):
+    size, fileobj = open_binary(ctx, prebuilt['key'], prebuilt['key'], prebuilt['md5'], None, stream)
+    if binary_cache or not stream:
+        return archive.ArchiveParts([(size, fileobj)])
+    return archive.iter_file(fileobj, stream_chunk_size)
+
+
+def has_binaries_to_fetch(items, etags):
+    """Whether a full payload of the items holds any binary, which is not the case once the client has all of them"""
+    return any(i.get('md5') not in etags and str(i.get('url') or '').startswith('s3://') for i in items)
+
+
+def payload_cost(items, etags):
+    """Estimated bytes a full payload holds while it is built and sent: the size of the binaries the client doesn't have"""
+    return sum(int(i.get('size') or default_binary_size) for i in items if i.get('md5') not in etags)
+
+
+def response_etag(manifest, current_md5s, patch_bases=None):
+    """
+    Strong ETag of the exact bytes of a response. Binaries the client already has are left out of it,
+    so those MD5s are part of the ETag, which is the manifest ETag when there are none. So are the base and target
+    MD5s of the patches sent instead of binaries, given by patch_bases as for build_packages_payload.
+    """
+    if not current_md5s:
+        return manifest
+    parts = [manifest, ','.join(sorted(current_md5s))]
+    if patch_bases:
+        parts.append(','.join(sorted(delta.patch_key(base['md5'], md5) for md5, base in patch_bases.items())))
+    return hashlib.md5('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def binary_path(md5, s3_key):
+    return "{0}{1}/{2}".format(binary_path_prefix, md5, s3_key)
+
+
+def resolve_once(key, compute, cache=True):
+    """
+    Run compute once for concurrent identical requests, which all share its result,
+    and unless cache is False keep that result in the result cache for later requests
+    """
+    coalesced = lambda: package_flights.do(key, compute)
+    if cache and result_cache:
+        return result_cache.get_or_compute(key, coalesced)
+    return coalesced()
+
+
+def request_envs(request_key):
+    """Envs a request asks for: its OS env and the env of each app and device attribute param"""
+    return {value for param, value in request_key if param not in ('cpuarch', 'payloadtype')}
+
+
+def canonical_params(params):
+    """Canonical form of the lowercased device params, with defaults filled in and in a fixed order"""
+    canonical = dict(params)
+    canonical.setdefault('os', 'prod')
+    canonical.setdefault('payloadtype', 'fullpayload')
+    return tuple(sorted(canonical.items()))
+
+
+def get_catalog_version(ctx):
+    """
+    Version token of the catalog. In snapshot mode this is the snapshot's own version, otherwise the version marker
+    item is read at most once every CATALOG_POLL_SECONDS.
+    """
+    global catalog_version, catalog_version_checked_at
+    if catalog_mode == 'snapshot':
+        return get_catalog(ctx).version
+    now = time.monotonic()
+    if now - catalog_version_checked_at >= catalog_poll_seconds:
+        catalog_version_checked_at = now
+        try:
+            catalog_version = DynamoCatalogSource(ctx.dynamodb, ctx.dynamo_table_name).poll_version()
+        except Exception as e:
+            print("Catalog version check failed: {0}".format(e))
+    return catalog_version
+
+
+def select_encoding(compression_param, accept_encoding):
+    """
+    Pick the content encoding of a full payload. An explicit compression query param wins, otherwise gzip is used
+    unless the client's Accept-Encoding rules it out. zstd is only chosen explicitly, since CloudFront only
+    normalizes gzip and br in the Accept-Encoding part of the cache key.
+    Returns None when the requested compression isn't supported.
+    """
+    if compression_param:
+        if compression_param == 'none':
+            compression_param = 'identity'
+        return compression_param if compression_param in archive.available_encodings else None
+
+    if accept_encoding is not None:
+        accepted = {e.split(';')[0].strip().lower() for e in accept_encoding.split(',')}
+        if 'gzip' not in accepted and '*' not in accepted:
+            return 'identity'
+    return 'gzip'
+
+
+def find_matching_apps(params, ctx):
+    return find_matching_apps_batch([params], ctx)[0]
+
+
+def find_matching_apps_batch(params_list, ctx):
+    """
+    Resolve the matching apps of several requests. In keys mode the Dynamo lookups of all of them are deduplicated
+    and made together. Returns an (items or error, status code, payload type) tuple per request.
+    """
+    valid_payload_types = ['fullpayload', 'metadataonly', 'compact']
+    responses = [None] * len(params_list)
+    profiles = []
+
+    for index, params in enumerate(params_list):
+        cpu_arch = params.get('cpuarch')
+        os_env = params.get('os', 'prod')
+        payload_type_param = params.get("payloadtype", "fullpayload")
+
+        # Lambda doesn't support return values greater than 1MB, so if a client requests a full payload while running in Lambda, return an error
+        if payload_type_param == "fullpayload" and running_in_lambda():
+            responses[index] = "'Full Payload' not available in this environment, please include the query param: payloadType=metadataOnly", 405, "json"
+        elif not cpu_arch:
+            responses[index] = "Missing cpuArch query param", 400, "json"
+        elif payload_type_param not in valid_payload_types:
+            responses[index] = "Invalid payloadType param", 400, "json"
+        else:
+            params.pop('cpuarch', None)
+            params.pop('payloadtype', None)
+            params.pop('os', None)
+            profiles.append((index, cpu_arch, os_env, params, payload_type_param))
+
+    if catalog_mode == 'snapshot':
+        matches = [get_catalog(ctx).match(cpu_arch, os_env, params) for _, cpu_arch, os_env, params, _ in profiles]
+    elif catalog_mode == 'keys':
+        lookups = [(cpu_arch, os_env, params) for _, cpu_arch, os_env, params, _ in profiles]
+        matches = lookup_matching_apps_batch(ctx.dynamodb, ctx.dynamo_table_name, lookups, lookup_executor) if lookups else []
+    else:
+        matches = [query_matching_apps(ctx, cpu_arch, os_env, params) for _, cpu_arch, os_env, params, _ in profiles]
+
+    for (index, _, _, _, payload_type_param), items in zip(profiles, matches):
+        if items:
+            responses[index] = items, 200, payload_type_param
+        else:
+            responses[index] = "No deployment package found", 404, "json"
+    return responses
+
+
+def query_matching_apps(ctx, cpu_arch, os_env, params):
+    partiql_statement = """SELECT url, app, version, md5, compressionRatio, previousVersions, "size" FROM "{0}" WHERE""".format(ctx.dynamo_table_name)
+    conditions = []
+    if not is_reserved_key('os_{0}'.format(cpu_arch), os_env):
+        conditions.append("(app = 'os_{0}' AND env = '{1}')".format(cpu_arch, os_env))
+    for k, v in params.items():
+        if k.startswith('attr'):
+            conditions.append("(deviceAttr.{0} = true AND env = '{1}')".format(k[4:], v))
+        elif not is_reserved_key(k, v):
+            conditions.append("(app = '{0}' AND env = '{1}')".format(k, v))
+    if not conditions:
+        return []
+    partiql_statement += " " + " or ".join(conditions)
+    print("Querying Dynamo:")
+    print(partiql_statement)
+    items = []
+    statement_params = {'Statement': partiql_statement}
+    while True:
+        raw_dynamo_response = ctx.dynamodb.execute_statement(**statement_params)
+        items.extend({k: deserializer.deserialize(v) for k, v in i.items()} for i in raw_dynamo_response.get('Items', []))
+        # A scan-style statement returns at most 1MB per call, the rest has to be paged through
+        if not raw_dynamo_response.get('NextToken'):
+            return items
+        statement_params['NextToken'] = raw_dynamo_response['NextToken']
+
+
+def get_catalog(ctx):
+    """Return the in-memory catalog snapshot, loading it on first use"""
+    global catalog
+    with catalog_lock:
+        if catalog is None:
+            if catalog_file:
+                source = FileCatalogSource(catalog_file)
+            else:
+                source = DynamoCatalogSource(ctx.dynamodb, ctx.dynamo_table_name)
+            catalog = CatalogSnapshot(source, catalog_refresh_seconds, catalog_poll_seconds)
+    return catalog
+
+
+def build_packages_payload(items, payload_type, etags, ctx, stream=False, encoding='gzip', patch_bases=None):
+    """
+    Build the response body of a request. patch_bases maps the MD5 of items to the previous version whose patch a full
+    payload sends instead of the binary, and is chosen here when not given.
+    """
+    print("Building payload")
+    object_key_pattern = "s3://.+/(.+)"
+    package_metadata = dict()
+    # Whatever order the catalog returned them in, the same items always give the same bytes
+    items = sorted(items, key=lambda i: (str(i.get('app')), str(i.get('env'))))
+    if payload_type == "fullpayload":
+        binaries_to_fetch = []
+        for item in items:
+
+            patch_metadata = None
+            if etags and item.get('md5') in etags:
+                status_code = 304
+            else:
+                status_code = 200
+                file_name = "{0}_{1}".format(item.get('app'), item.get('version'))
+
+                if item.get('url').startswith('s3://'):
+                    s3_key = re.search(object_key_pattern, item.get('url')).group(1)
+                    if patch_bases is None:
+                        base = choose_patch_base(ctx, s3_key, item, etags)
+                    else:
+                        base = patch_bases.get(item.get('md5'))
+                    if base:
+                        file_name = "{0}_from_{1}.{2}".format(file_name, base.get('version'), delta.patch_format)
+                        patch_metadata = {
+                            'file': file_name,
+                            'format': delta.patch_format,
+                            'baseVersion': base.get('version'),
+                            'baseMd5': base.get('md5'),
+                            'targetMd5': item.get('md5')
+                        }
+                    binaries_to_fetch.append((file_name, s3_key, item.get('md5'), base))
+                    if item.get('compressionRatio') is not None:
+                        binary_compression_ratios.setdefault(item.get('md5'), float(item.get('compressionRatio')))
+                else:
+                    # Could add support for generic HTTP URLs here
+                    print("Unsupported URL type")
+            
+            package_metadata[item.get('app')] = {
+                'latestVersion': item.get('version'),
+                'url': download_url(item),
+                'status_code': status_code
+            } 
+            if patch_metadata:
+                package_metadata[item.get('app')]['patch'] = patch_metadata
+
+        telemetry.count('binaries', len(binaries_to_fetch))
+        if binaries_to_fetch:
+            metadata = json.dumps(package_metadata, sort_keys=True).encode('utf-8')
+            if stream and binary_cache and (precompressed_members or encoding == 'identity'):
+                # Every part comes from the binary cache, so the archive's length is known and ranges can be served
+                response = open_payload_parts(ctx, binaries_to_fetch, metadata, encoding), 200, tar_payload_types[encoding]
+                return response
+            # When streaming, binaries are read while the archive is being sent so only a few chunks are held in memory
+            archive_chunks = assemble_payload(ctx, binaries_to_fetch, metadata, encoding, stream)
+            if stream:
+                response = archive_chunks, 200, tar_payload_types[encoding]
+            else:
+                response = b''.join(archive_chunks), 200, tar_payload_types[encoding]
+        else:
+            response = "Not Modified", 304, "json"
+
+    elif payload_type == "metadataonly":
+        package_metadata = metadata_entries(items, etags)
+        if any(entry['status_code'] == 200 for entry in package_metadata.values()):
+            response = json.dumps(package_metadata, sort_keys=True), 200, "json"
+        else:
+            response = "Not Modified", 304, "json"
+
+    elif payload_type == "compact":
+        package_metadata = metadata_entries(items, etags)
+        if any(entry['status_code'] == 200 for entry in package_metadata.values()):
+            manifest = compact.encode_manifest(package_metadata)
+            if encoding != 'identity':
+                manifest = b''.join(archive.iter_compressed([manifest], encoding, compression_levels[encoding]))
+            response = manifest, 200, compact_payload_types[encoding]
+        else:
+            response = "Not Modified", 304, "json"
+    return response
+
+
+def metadata_entries(items, etags):
+    """Metadata document entry of each item, by app, marking the binaries the client already has with a 304"""
+    package_metadata = dict()
+    for item in items:
+        package_metadata[item.get('app')] = {
+            'latestVersion': item.get('version'),
+            'url': download_url(item),
+            'md5': item.get('md5'),
+            'status_code': 304 if etags and item.get('md5') in etags else 200
+        }
+    return package_metadata
+
+
+def download_url(item):
+    """URL a device can fetch a single binary from: the binary route for binaries in S3, the item's own URL otherwise"""
+    url = item.get('url')
+    match = re.fullmatch("s3://.+/(.+)", url) if url else None
+    if match and item.get('md5'):
+        return binary_path(item.get('md5'), match.group(1))
+    return url
+
+
+def assemble_payload(ctx, binaries, metadata, encoding, stream):
+    """
+    Yield a tar archive holding the binaries followed by package_details.json, compressed with the given encoding.
+    Each binary is compressed as its own gzip member or zstd frame, which concatenate into a valid stream and let
+    each binary pick its own compression level. With the binary cache enabled those compressed members are built
+    once and reused, so a request only compresses package_details.json.
+    """
+    if encoding == 'identity':
+        members = (
+            (file_name, size, archive.iter_file(fileobj, stream_chunk_size))
+            for (file_name, _, _, _), (size, fileobj) in zip(binaries, open_concurrently(ctx, open_binary, binaries, stream))
+        )
+        members = itertools.chain(members, [("package_details.json", len(metadata), [metadata])])
+        yield from archive.iter_tar(members)
+        return
+
+    if binary_cache and precompressed_members:
+        for size, fileobj in open_concurrently(ctx, open_compressed_member, binaries, encoding):
+            yield from archive.iter_file(fileobj, stream_chunk_size)
+    else:
+        for (file_name, _, md5, base), (size, fileobj) in zip(binaries, open_concurrently(ctx, open_binary, binaries, stream)):
+            content_key = delta.patch_key(base['md5'], md5) if base else md5
+            yield from iter_compressed_member(file_name, content_key, size, archive.iter_file(fileobj, stream_chunk_size), encoding)
+    yield from archive.iter_tar_trailer("package_details.json", metadata, encoding, compression_levels[encoding])
+
+
+def open_payload_parts(ctx, binaries, metadata, encoding):
+    """
+    Open every part of a full payload from the binary cache: the cached compressed members, or the raw binaries
+    between their tar headers and padding, followed by package_details.json
+    """
+    parts = []
+    try:
+        if encoding == 'identity':
+            for (file_name, _, _, _), (size, fileobj) in zip(binaries, open_concurrently(ctx, open_binary, binaries, True)):
+                parts += [archive.tar_member_header(file_name, size), (size, fileobj), archive.tar_member_padding(size)]
+            parts.append(b''.join(archive.iter_tar([("package_details.json", len(metadata), [metadata])])))
+        else:
+            parts += open_concurrently(ctx, open_compressed_member, binaries, encoding)
+            parts.append(b''.join(archive.iter_tar_trailer("package_details.json", metadata, encoding, compression_levels[encoding])))
+    except BaseException:
+        archive.ArchiveParts(parts).close()
+        raise
+    return archive.ArchiveParts(parts)
+
+
+def iter_compressed_member(file_name, md5, size, chunks, encoding):
+    """Compress a binary's tar member, skipping compression when a sample of the binary shows it won't pay off"""
+    chunks = iter(chunks)
+    first_chunk = next(chunks, b'')
+    level = compression_level(md5, first_chunk, encoding)
+    tar_member = archive.iter_tar_member(file_name, size, itertools.chain([first_chunk], chunks))
+    # Includes the time spent waiting for the binary, which is also part of the s3 stage when it comes from S3
+    return telemetry.iter_measured('compress', archive.iter_compressed(tar_member, encoding, level))
+
+
+def compression_level(md5, sample, encoding):
+    ratio = binary_compression_ratios.get(md5)
+    if ratio is None:
+        ratio = archive.compression_ratio(sample[:archive.compressibility_sample_size])
+        binary_compression_ratios[md5] = ratio
+    if ratio > 1 - compression_min_savings:
+        return store_compression_levels[encoding]
+    return compression_levels[encoding]
+
+
+def open_binary(ctx, file_name, s3_key, md5, base, stream):
+    """
+    Return (size, fileobj) for a binary, reading it from the local binary cache when it is enabled,
+    or for the patch to it from base, a previous version, when one is given
+    """
+    if base:
+        return open_patch(ctx, s3_key, md5, base)
+    if binary_cache and md5:
+        fileobj = binary_cache.open(md5, lambda f: download_s3_object(ctx, s3_key, f), md5)
+        return os.fstat(fileobj.fileno()).st_size, fileobj
+    if stream:
+        s3_object = get_s3_object(ctx, s3_key)
+        return s3_object['ContentLength'], s3_object['Body']
+    data = io.BytesIO()
+    download_s3_object(ctx, s3_key, data)
+    data.seek(0)
+    return len(data.getbuffer()), data
+
+
+def get_s3_object(ctx, s3_key, md5=None):
+    """
+    GetObject from the binaries bucket, reporting the call and the reads of the body to the s3 stage.
+    When md5 is given, S3 fails the call with a 412 unless the object's ETag, the MD5 of its content, matches it.
+    """
+    conditions = {'IfMatch': '"{0}"'.format(md5)} if md5 else {}
+    with telemetry.stage('s3'):
+        s3_object = ctx.s3.get_object(Bucket=ctx.binaries_bucket_name, Key=s3_key, **conditions)
+    s3_object['Body'] = telemetry.MeasuredReader(s3_object['Body'], 's3', 'bytes_fetched')
+    return s3_object
+
+
+def download_s3_object(ctx, s3_key, fileobj):
+    """Download an object of the binaries bucket into a file object, reporting it to the s3 stage"""
+    with telemetry.stage('s3'):
+        ctx.s3.download_fileobj(ctx.binaries_bucket_name, s3_key, telemetry.CountingWriter(fileobj, 'bytes_fetched'))
+
+
+def open_compressed_member(ctx, file_name, s3_key, md5, base, encoding):
+    """
+    Return (size, fileobj) for the cached compressed member holding the tar header and body of a binary,
+    or of the patch to it from base, building it on first use
+    """
+    content_key = delta.patch_key(base['md5'], md5) if base else md5
+    cache_key = "{0}.{1}.{2}{3}.v{4}".format(
+        content_key, hashlib.md5(file_name.encode('utf-8')).hexdigest(), encoding, compression_levels[encoding], archive.format_version)
+
+    def compress_member(fileobj):
+        if base:
+            size, source = open_patch(ctx, s3_key, md5, base)
+            chunks = archive.iter_file(source, stream_chunk_size)
+        else:
+            s3_object = get_s3_object(ctx, s3_key)
+            size = s3_object['ContentLength']
+            chunks = iter_verified(archive.iter_file(s3_object['Body'], stream_chunk_size), md5, s3_key)
+        for compressed in iter_compressed_member(file_name, content_key, size, chunks, encoding):
+            fileobj.write(compressed)
+
+    fileobj = binary_cache.open(cache_key, compress_member)
+    return os.fstat(fileobj.fileno()).st_size, fileobj
+
+
+def choose_patch_bases(ctx, items, etags):
+    """The previous version whose patch is sent instead of each binary of a full payload, by the MD5 of the item"""
+    patch_bases = dict()
+    for item in items:
+        match = re.fullmatch("s3://.+/(.+)", item.get('url') or '')
+        if match and item.get('md5') not in etags:
+            base = choose_patch_base(ctx, match.group(1), item, etags)
+            if base:
+                patch_bases[item.get('md5')] = base
+    return patch_bases
+
+
+def choose_patch_base(ctx, s3_key, item, etags):
+    """
+    The previous version of an item that the device has installed, if the patch from it is small enough to be
+    worth sending instead of the full binary. A patch that isn't stored yet is generated in the background, and sent
+    to the devices asking after that, while this one gets the full binary.
+    """
+    if not (delta_updates and binary_cache and etags):
+        return None
+    base = delta.find_base(item, etags)
+    if not base:
+        return None
+    key = delta.patch_key(base['md5'], item.get('md5'))
+    try:
+        patch = open_stored_patch(ctx, key)
+        if not patch:
+            generate_patch_later(ctx, key, s3_key, item.get('md5'), base, item.get('size'))
+            return None
+        patch_size = os.fstat(patch.fileno()).st_size
+        patch.close()
+        size, fileobj = open_binary(ctx, s3_key, s3_key, item.get('md5'), None, False)
+        fileobj.close()
+    except Exception as e:
+        print("Patch for {0} unavailable: {1}".format(s3_key, e))
+        return None
+    return base if patch_size <= size * delta_max_ratio else None
+
+
+def open_patch(ctx, s3_key, md5, base):
+    """Return (size, fileobj) for the patch from base, a previousVersions entry, to a binary. It must be stored already"""
+    fileobj = open_stored_patch(ctx, delta.patch_key(base['md5'], md5))
+    if not fileobj:
+        raise RuntimeError("Patch for {0} from {1} is not stored".format(s3_key, base['md5']))
+    return os.fstat(fileobj.fileno()).st_size, fileobj
+
+
+def open_stored_patch(ctx, key):
+    """
+    The patch with this key from the binary cache, or from the bucket if another instance stored it there, or None.
+    Patches are content-addressed by the MD5s of both binaries.
+    """
+    fileobj = binary_cache.get(key)
+    if fileobj or not patch_bucket_prefix or key in patches_in_progress:
+        return fileobj
+
+    def fill_patch(fileobj):
+        s3_object = get_s3_object(ctx, patch_bucket_prefix + key)
+        for chunk in archive.iter_file(s3_object['Body'], stream_chunk_size):
+            fileobj.write(chunk)
+
+    try:
+        return binary_cache.open(key, fill_patch)
+    except ClientError as e:
+        # Without s3:ListBucket on the prefix, S3 reports a missing object as AccessDenied
+        if e.response['Error']['Code'] not in ('NoSuchKey', 'AccessDenied'):
+            raise
+        return None
+
+
+def generate_patch_later(ctx, key, s3_key, md5, base, target_size):
+    """Have the patch from base to a binary of target_size bytes generated in the background, once"""
+    with patches_lock:
+        if key in patches_in_progress:
+            return
+        patches_in_progress.add(key)
+    patch_executor.submit(generate_patch, ctx, key, s3_key, md5, base, target_size)
+
+
+def generate_patch(ctx, key, s3_key, md5, base, target_size):
+    """Generate a patch into the binary cache, and store it in the bucket for other instances"""
+    try:
+        base_s3_key = re.search("s3://.+/(.+)", base['url']).group(1)
+        # bsdiff holds both binaries and a suffix array of the base, many times the target's size, so generating
+        # a patch is charged to admission control like a request
+        cost = patch_memory_factor * int(target_size or default_binary_size)
+        if admission and not admission.acquire(cost):
+            print("Not enough memory budget to generate patch {0}, a later request will retry".format(key))
+            return
+        try:
+            patch = delta.diff(read_binary(ctx, base_s3_key, base['md5']), read_binary(ctx, s3_key, md5))
+        finally:
+            if admission:
+                admission.release(cost)
+        binary_cache.open(key, lambda fileobj: fileobj.write(patch)).close()
+        if patch_bucket_prefix:
+            ctx.s3.put_object(Bucket=ctx.binaries_bucket_name, Key=patch_bucket_prefix + key, Body=patch)
+    except Exception as e:
+        print("Generating patch {0} failed: {1}".format(key, e))
+    finally:
+        with patches_lock:
+            patches_in_progress.discard(key)
+
+
+def read_binary(ctx, s3_key, md5):
+    size, fileobj = open_binary(ctx, s3_key, s3_key, md5, None, False)
+    with fileobj:
+        return fileobj.read()
+
+
+def open_concurrently(ctx, opener, binaries, *args):
+    """
+    Yield opener(ctx, file_name, s3_key, md5, base, *args) for each of the given (file_name, s3_key, md5, base) tuples.
+    All binaries are opened at once with a bounded worker pool, but results are yielded in the given order.
+    """
+    executor = ThreadPoolExecutor(max_workers=min(s3_fetch_concurrency, len(binaries)))
+    pending = [executor.submit(telemetry.in_context(opener), ctx, *binary, *args) for binary in binaries]
+    yielded = 0
+    try:
+        for opened in pending:
+            yielded += 1
+            yield opened.result()
+    finally:
+        # If the client disconnects mid-download, release anything that was opened but never handed out
+        for opened in pending[yielded:]:
+            if not opened.cancel() and not opened.exception():
+                opened.result()[1].close()
+        executor.shutdown(wait=False)
+
+
+def create_http_response(results, status_code, payload_type='json', etag=None):
+
+    if status_code == 200:
+        response = create_success_response(status_code, payload_type, results)
+    else:
+        response = create_error_response(status_code, results)
+    if etag:
+        response['headers']['ETag'] = '"{0}"'.format(etag)
+
+    return response
+
+
+def create_payload_head_response(etag, envs, encoding, prebuilt, stream):
+    """
+    Headers of a full payload, without building it. Its Content-Length is only sent for a prebuilt package,
+    as the length of any other payload is only known once it has been compressed
+    """
+    # An empty iterable rather than '', which would be sent with a Content-Length of 0
+    response = create_http_response(iter(()), 200, tar_payload_types[encoding], etag)
+    response['headers']['Cache-Control'] = cache_policy.cache_control(200, envs)
+    if prebuilt and prebuilt.get('size') is not None:
+        response['headers']['Content-Length'] = str(int(prebuilt['size']))
+    # Ranges are served from the payloads apply_range gets with a known length
+    if not stream or binary_cache and (prebuilt or precompressed_members or encoding == 'identity'):
+        response['headers']['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def apply_range(response, headers):
+    """
+    Send the Content-Length of a full payload whose size is known, and serve the byte range of a Range header
+    from it, unless an If-Range header shows the client's partial copy is of a different payload
+    """
+    body = response['body']
+    if isinstance(body, archive.ArchiveParts):
+        size = body.size
+    elif isinstance(body, bytes):
+        size = len(body)
+    else:
+        return response
+
+    first, last = 0, size - 1
+    byte_range = parse_range(headers.get('Range'), size)
+    if_range = headers.get('If-Range')
+    if byte_range and (not if_range or if_range.strip() == response['headers'].get('ETag')):
+        if byte_range[0] >= size:
+            if isinstance(body, archive.ArchiveParts):
+                body.close()
+            response = create_error_response(416, "Range not satisfiable")
+            # Range isn't part of the cache key, so this must not be cached in place of the payload
+            response['headers']['Cache-Control'] = 'no-store'
+            response['headers']['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+        if byte_range[0] <= byte_range[1]:
+            first, last = byte_range
+            response['status_code'] = 206
+            response['headers']['Content-Range'] = 'bytes {0}-{1}/{2}'.format(first, last, size)
+
+    if isinstance(body, archive.ArchiveParts):
+        response['body'] = body.iter_range(first, last, stream_chunk_size)
+    elif (first, last) != (0, size - 1):
+        response['body'] = body[first:last + 1]
+    response['headers']['Accept-Ranges'] = 'bytes'
+    response['headers']['Content-Length'] = str(last - first + 1)
+    return response
+
+
+def parse_range(range_header, size):
+    """(first, last) byte positions of a single bytes range in a Range header, or None when there isn't one"""
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', range_header or '')
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range, the last N bytes
+        return max(size - int(last), 0) if int(last) else size, size - 1
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def create_overloaded_response():
+    response = create_error_response(503, "Too many package requests, please retry later")
+    # Shedding is temporary, so it must not be cached by CloudFront
+    response['headers']['Cache-Control'] = 'no-store'
+    response['headers']['Retry-After'] = str(admission_retry_after_seconds)
+    return response
+
+
+def create_not_modified_response(etag, envs=()):
+    return {
+        'status_code': 304,
+        'headers': {
+            'Cache-Control': cache_policy.cache_control(304, envs),
+            'ETag': '"{0}"'.format(etag)
+        },
+        'body': ''
+    }
+
+def create_success_response(status_code, payload_type, results):
+
+    content_type_map = {
+        'json': 'application/json',
+        'tar': 'application/x-gzip',
+        'tar_zstd': 'application/zstd',
+        'tar_identity': 'application/x-tar',
+        'cbor': compact.content_type,
+        'cbor_gzip': compact.content_type,
+        'cbor_zstd': compact.content_type
+    }
+
+    payload_type_specific_headers = {
+        'json': {},
+        'tar': {
+            'Content-Encoding': 'gzip',
+            'Content-Disposition': 'attachment; filename="ota-package.tar.gz" ',
+            'Vary': 'Accept-Encoding'
+        },
+        'tar_zstd': {
+            'Content-Encoding': 'zstd',
+            'Content-Disposition': 'attachment; filename="ota-package.tar.zst" ',
+            'Vary': 'Accept-Encoding'
+        },
+        'tar_identity': {
+            'Content-Disposition': 'attachment; filename="ota-package.tar" ',
+            'Vary': 'Accept-Encoding'
+        },
+        'cbor': {},
+        'cbor_gzip': {
+            'Content-Encoding': 'gzip'
+        },
+        'cbor_zstd': {
+            'Content-Encoding': 'zstd'
+        }
+    }
+
+    success_response = {
+        'status_code': status_code,
+        'headers': {
+            'Cache-Control': cache_policy.cache_control(status_code),
+            'Content-Type': content_type_map[payload_type],
+            **payload_type_specific_headers[payload_type]
+        },
+        'body': results
+    }
+
+    return success_response
+
+def create_error_response(status_code, results):
+    base_error_response = {
+        'status_code': status_code,
+        'headers': {
+            'Cache-Control': cache_policy.cache_control(status_code),
+            'Content-Type': 'application/json'
+        },
+        'body': json.dumps({
+            'error': results
+        })
+    }
+
+    internal_server_error_response = {
+        'status_code': 500,
+        'headers': {
+            'Cache-Control': 'max-age=1',
+            "Content-Type": 'application/json'
+        },
+        'body': {
+            'error': 'Internal Server Error'
+        }
+    }
+    return base_error_response
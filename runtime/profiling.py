@@ -0,0 +1,172 @@
+import cProfile
+import hashlib
+import hmac
+import io
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+
+# Package requests can be profiled with cProfile and tracemalloc, either a random sample of them
+profile_sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# or those carrying an X-OTA-Profile header signed with this secret, see sign()
+profile_secret = os.environ.get('PROFILE_SECRET', '')
+# Profiles are written to this directory, and uploaded to the binaries bucket under this prefix when it is set
+profile_dir = os.environ.get('PROFILE_DIR', '/tmp/ota-profiles')
+profile_s3_prefix = os.environ.get('PROFILE_S3_PREFIX', '')
+# Number of functions and allocation sites listed in each profile
+profile_top = int(os.environ.get('PROFILE_TOP', 30))
+# Frames kept per allocation, enough to tell which part of the runtime made it
+profile_trace_frames = 25
+# When neither is set, profiling costs requests a single check of this flag
+enabled = profile_sample_rate > 0 or bool(profile_secret)
+
+profile_header = 'X-OTA-Profile'
+profiling_file = os.path.abspath(__file__)
+runtime_dir = os.path.dirname(profiling_file)
+# tracemalloc traces the whole process, so only one request is profiled at a time
+profile_lock = threading.Lock()
+
+
+def sign(secret, query_string, expires):
+    """X-OTA-Profile header value asking to profile a request with the given query string until expires (Unix time)"""
+    message = "{0}\n{1}".format(expires, query_string).encode('utf-8')
+    return "{0}:{1}".format(expires, hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest())
+
+
+def requested(headers, query_string):
+    """Whether to profile a request: it is sampled, or it carries a valid signature that hasn't expired"""
+    if profile_sample_rate and random.random() < profile_sample_rate:
+        return True
+    signature = headers.get(profile_header)
+    if not (profile_secret and signature):
+        return False
+    expires = signature.split(':', 1)[0]
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(sign(profile_secret, query_string, expires), signature)
+
+
+def profile(handler, description, upload=None):
+    """
+    Call a request handler under cProfile and tracemalloc, which keep running while a streamed body is produced,
+    and write a report once the body has been closed. Only the request's own thread is profiled, not the pool
+    threads fetching binaries. The request isn't profiled if another one is.
+    upload, if given, is called with the name and content of each file of the report.
+    """
+    if not profile_lock.acquire(blocking=False):
+        return handler()
+    profiled = ProfiledRequest(description, upload)
+    try:
+        response = profiled.run(handler)
+    except BaseException:
+        profiled.finish(None)
+        raise
+    if isinstance(response['body'], (bytes, str)):
+        profiled.finish(response['status_code'])
+    else:
+        response['body'] = ProfiledBody(response['body'], profiled, response['status_code'])
+    return response
+
+
+class ProfiledRequest:
+
+    def __init__(self, description, upload):
+        self.description = description
+        self.upload = upload
+        self.profiler = cProfile.Profile()
+        self.started = time.perf_counter()
+        self.snapshot = None
+        self.snapshot_size = -1
+        tracemalloc.start(profile_trace_frames)
+
+    def run(self, fn, *args):
+        try:
+            return self.profiler.runcall(fn, *args)
+        finally:
+            self.take_snapshot()
+
+    def take_snapshot(self):
+        """Keep a snapshot of the allocations whenever they are higher than in the last one"""
+        size = tracemalloc.get_traced_memory()[0]
+        if size > self.snapshot_size:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = size
+
+    def finish(self, status_code):
+        try:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            if status_code is not None:
+                self.write_report(status_code, peak)
+        except Exception as e:
+            print("Writing profile failed: {0}".format(e))
+        finally:
+            profile_lock.release()
+
+    def write_report(self, status_code, peak):
+        name = "{0}-{1}".format(time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), uuid.uuid4().hex[:8])
+        report = io.StringIO()
+        report.write("{0}\nStatus {1} in {2:.1f}ms\n\n".format(
+            self.description, status_code, (time.perf_counter() - self.started) * 1000))
+        pstats.Stats(self.profiler, stream=report).sort_stats('cumulative').print_stats(profile_top)
+        report.write("Peak traced memory: {0} bytes\n".format(peak))
+        if self.snapshot:
+            report.write("Top allocation sites of the runtime, at {0} bytes:\n".format(self.snapshot_size))
+            for (filename, lineno), (size, count) in self.allocation_sites()[:profile_top]:
+                report.write("{0} bytes in {1} blocks, from {2}:{3}\n".format(
+                    size, count, os.path.relpath(filename, runtime_dir), lineno))
+
+        # The .prof file can be loaded with pstats or a viewer such as snakeviz
+        os.makedirs(profile_dir, exist_ok=True)
+        self.profiler.dump_stats(os.path.join(profile_dir, name + '.prof'))
+        with open(os.path.join(profile_dir, name + '.txt'), 'w') as report_file:
+            report_file.write(report.getvalue())
+        if self.upload:
+            for file_name in (name + '.prof', name + '.txt'):
+                with open(os.path.join(profile_dir, file_name), 'rb') as report_file:
+                    self.upload(file_name, report_file.read())
+        print("Wrote profile {0}".format(os.path.join(profile_dir, name)))
+
+    def allocation_sites(self):
+        """Live allocations of the peak snapshot grouped by the innermost runtime line that made them, largest first"""
+        sites = dict()
+        for trace in self.snapshot.traces:
+            frame = next((f for f in reversed(trace.traceback)
+                          if f.filename.startswith(runtime_dir) and f.filename != profiling_file), None)
+            if frame:
+                size, count = sites.get((frame.filename, frame.lineno), (0, 0))
+                sites[(frame.filename, frame.lineno)] = (size + trace.size, count + 1)
+        return sorted(sites.items(), key=lambda site: site[1][0], reverse=True)
+
+
+class ProfiledBody:
+    """Response body that is produced under the request's profiler, and finishes the profile when it is closed"""
+
+    def __init__(self, body, profiled, status_code):
+        self.body = body
+        self.profiled = profiled
+        self.status_code = status_code
+        self._closed = False
+
+    def __iter__(self):
+        chunks = iter([self.body] if isinstance(self.body, (bytes, str)) else self.body)
+        while True:
+            try:
+                chunk = self.profiled.run(next, chunks)
+            except StopIteration:
+                return
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.profiled.run(self.body.close)
+        finally:
+            self.profiled.finish(self.status_code)
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Thread-safe in-process LRU cache whose entries also expire after ttl seconds.
+    Entries belong to a catalog version: when a different version is seen, every entry is dropped.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.catalog_version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_version(self, catalog_version):
+        if catalog_version == self.catalog_version:
+            return
+        with self._lock:
+            if catalog_version != self.catalog_version:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self.catalog_version = catalog_version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'catalog_version': self.catalog_version
+            }
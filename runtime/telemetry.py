@@ -0,0 +1,222 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Add a Server-Timing header with the duration of each stage to package responses
+server_timing = os.environ.get('SERVER_TIMING', 'true').lower() == 'true'
+# Fraction of package requests whose metrics are logged, as CloudWatch embedded metric format (EMF) lines
+metrics_sample_rate = float(os.environ.get('METRICS_SAMPLE_RATE', 0.01))
+# Requests that take longer than this, body included, are always logged. 0 disables it
+metrics_slow_ms = float(os.environ.get('METRICS_SLOW_MS', 1000))
+metrics_namespace = os.environ.get('METRICS_NAMESPACE', 'CloudFrontOTA')
+
+# Metrics of the request being handled. Work handed to other threads has to be run in a copy of the context
+current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Time spent in each stage of a request, and its counters. Stages may run in several threads at once"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = dict()
+        self.counters = dict()
+        self.dimensions = {'PayloadType': 'none'}
+        self.properties = dict()
+        self._lock = threading.Lock()
+
+    def add_duration(self, stage_name, seconds):
+        with self._lock:
+            self.durations[stage_name] = self.durations.get(stage_name, 0) + seconds
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def server_timing(self):
+        """Server-Timing header value of the stages so far, in milliseconds"""
+        with self._lock:
+            durations = list(self.durations.items())
+        durations.append(('total', time.perf_counter() - self.started))
+        return ', '.join('{0};dur={1:.1f}'.format(stage_name, seconds * 1000) for stage_name, seconds in durations)
+
+    def emit(self):
+        """Log the metrics as an EMF line if the request is sampled or slow"""
+        total_ms = (time.perf_counter() - self.started) * 1000
+        if random.random() >= metrics_sample_rate and not (metrics_slow_ms and total_ms >= metrics_slow_ms):
+            return
+        with self._lock:
+            values = {stage_name: round(seconds * 1000, 3) for stage_name, seconds in self.durations.items()}
+            values['total'] = round(total_ms, 3)
+            units = {stage_name: 'Milliseconds' for stage_name in values}
+            for counter, n in self.counters.items():
+                values[counter] = n
+                units[counter] = 'Bytes' if counter.startswith('bytes') else 'Count'
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': metrics_namespace,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()]
+                }]
+            },
+            **self.dimensions,
+            **self.properties,
+            **values
+        }
+        print(json.dumps(record, separators=(',', ':')))
+
+
+def measure(handler, *args, **kwargs):
+    """
+    Call a request handler while collecting its metrics, and add a Server-Timing header to its response.
+    A streamed body is wrapped so that producing it is timed too, and the metrics are logged once it is closed.
+    """
+    context = contextvars.copy_context()
+    return context.run(_measure, context, handler, args, kwargs)
+
+
+def _measure(context, handler, args, kwargs):
+    metrics = RequestMetrics()
+    current.set(metrics)
+    response = handler(*args, **kwargs)
+    metrics.properties['StatusCode'] = response['status_code']
+    if server_timing:
+        response['headers']['Server-Timing'] = metrics.server_timing()
+    metrics.add_duration('respond', time.perf_counter() - metrics.started)
+    if isinstance(response['body'], (bytes, str)):
+        metrics.count('bytes_sent', len(response['body']))
+        metrics.emit()
+    else:
+        response['body'] = MeasuredBody(response['body'], metrics, context)
+    return response
+
+
+@contextmanager
+def stage(stage_name):
+    """Add the time spent in the block to a stage of the current request, if there is one"""
+    metrics = current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_duration(stage_name, time.perf_counter() - started)
+
+
+def count(counter, n=1):
+    metrics = current.get()
+    if metrics is not None:
+        metrics.count(counter, n)
+
+
+def set_dimension(name, value):
+    metrics = current.get()
+    if metrics is not None:
+        metrics.dimensions[name] = value
+
+
+def iter_measured(stage_name, chunks):
+    """Pass chunks through, adding the time spent producing them to a stage of the current request"""
+    metrics = current.get()
+    if metrics is None:
+        yield from chunks
+        return
+    chunks = iter(chunks)
+    while True:
+        started = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            metrics.add_duration(stage_name, time.perf_counter() - started)
+        yield chunk
+
+
+def in_context(fn):
+    """Wrap fn to run in a copy of the current context, e.g. in a worker thread, so it still reports to this request"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+class MeasuredReader:
+    """File object wrapper adding the time spent in, and the bytes returned by, read() to the request that opened it"""
+
+    def __init__(self, fileobj, stage_name, counter):
+        self.fileobj = fileobj
+        self.stage_name = stage_name
+        self.counter = counter
+        self.metrics = current.get()
+
+    def read(self, size=-1):
+        if self.metrics is None:
+            return self.fileobj.read(size)
+        started = time.perf_counter()
+        data = self.fileobj.read(size)
+        self.metrics.add_duration(self.stage_name, time.perf_counter() - started)
+        self.metrics.count(self.counter, len(data))
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class CountingWriter:
+    """File object wrapper adding the bytes written to a counter of the request that opened it"""
+
+    def __init__(self, fileobj, counter):
+        self.fileobj = fileobj
+        self.counter = counter
+        self.metrics = current.get()
+
+    def write(self, data):
+        if self.metrics is not None:
+            self.metrics.count(self.counter, len(data))
+        return self.fileobj.write(data)
+
+
+class MeasuredBody:
+    """
+    Response body that times the production of each chunk and counts the bytes sent, then logs the request's
+    metrics when the server closes it. The time between chunks is spent sending them
+    """
+
+    def __init__(self, body, metrics, context):
+        self.body = body
+        self.metrics = metrics
+        self.context = context
+        self._closed = False
+
+    def __iter__(self):
+        chunks = iter([self.body] if isinstance(self.body, (bytes, str)) else self.body)
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = self.context.run(next, chunks)
+            except StopIteration:
+                return
+            finally:
+                self.metrics.add_duration('stream', time.perf_counter() - started)
+            self.metrics.count('bytes_sent', len(chunk))
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.context.run(self.body.close)
+        finally:
+            durations = self.metrics.durations
+            elapsed = time.perf_counter() - self.metrics.started
+            self.metrics.add_duration('send', max(elapsed - durations.get('respond', 0) - durations.get('stream', 0), 0))
+            self.metrics.emit()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The runtime modules are flat files, imported the way the container and the Lambda import them, next to the
+# scripts at the root of the repo
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(repo_dir, 'runtime'))
+sys.path.insert(0, repo_dir)
+# Keep handlers.py from opening the shared binary cache directory when it is imported
+os.environ.setdefault('BINARY_CACHE_MAX_BYTES', '0')
@@ -0,0 +1,67 @@
+import threading
+import time
+
+from admission import AdmissionController, ReleasingBody
+
+
+def test_requests_within_budget_are_admitted():
+    admission = AdmissionController(100, 1, 0)
+    assert admission.acquire(60)
+    assert admission.acquire(40)
+    assert admission.stats()['in_flight_bytes'] == 100
+    admission.release(60)
+    admission.release(40)
+    assert admission.stats()['in_flight'] == 0
+    assert admission.stats()['in_flight_bytes'] == 0
+
+
+def test_queued_request_is_admitted_on_release():
+    admission = AdmissionController(100, 1, 5)
+    assert admission.acquire(80)
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(admission.acquire(50)))
+    waiter.start()
+    while admission.stats()['queued'] == 0:
+        time.sleep(0.001)
+    assert results == []
+
+    admission.release(80)
+    waiter.join(5)
+    assert results == [True]
+    assert admission.stats()['in_flight_bytes'] == 50
+
+
+def test_request_is_rejected_when_its_wait_runs_out():
+    admission = AdmissionController(100, 1, 0.05)
+    assert admission.acquire(80)
+    assert not admission.acquire(50)
+    stats = admission.stats()
+    assert stats['rejected'] == 1
+    assert stats['queued'] == 0
+
+
+def test_request_is_rejected_when_the_queue_is_full():
+    admission = AdmissionController(100, 0, 5)
+    assert admission.acquire(80)
+    started = time.monotonic()
+    assert not admission.acquire(50)
+    # Rejected straight away rather than after the queue timeout
+    assert time.monotonic() - started < 1
+
+
+def test_request_over_the_whole_budget_is_admitted_alone():
+    admission = AdmissionController(100, 1, 0.05)
+    assert admission.acquire(500)
+    assert not admission.acquire(1)
+    admission.release(500)
+    assert admission.stats()['in_flight_bytes'] == 0
+    assert admission.acquire(1)
+
+
+def test_releasing_body_releases_once():
+    releases = []
+    body = ReleasingBody([b'a', b'b'], lambda: releases.append(1))
+    assert b''.join(body) == b'ab'
+    body.close()
+    body.close()
+    assert releases == [1]
@@ -0,0 +1,74 @@
+import hashlib
+import os
+
+import pytest
+
+from binary_cache import BinaryCache
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def filler(data, calls=None):
+    def fill(fileobj):
+        if calls is not None:
+            calls.append(data)
+        fileobj.write(data)
+    return fill
+
+
+def test_miss_then_hit(tmp_path):
+    cache = BinaryCache(str(tmp_path), 100)
+    data = b'a' * 10
+    calls = []
+    with cache.open(md5(data), filler(data, calls), md5(data)) as fileobj:
+        assert fileobj.read() == data
+    with cache.open(md5(data), filler(data, calls), md5(data)) as fileobj:
+        assert fileobj.read() == data
+    assert len(calls) == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = BinaryCache(str(tmp_path), 25)
+    first, second, third = b'1' * 10, b'2' * 10, b'3' * 10
+    cache.open(md5(first), filler(first), md5(first)).close()
+    cache.open(md5(second), filler(second), md5(second)).close()
+    # Using the first entry again makes the second one the least recently used
+    cache.open(md5(first), filler(first), md5(first)).close()
+    cache.open(md5(third), filler(third), md5(third)).close()
+
+    assert sorted(os.listdir(str(tmp_path))) == sorted([md5(first), md5(third)])
+    assert cache.stats()['bytes'] == 20
+    calls = []
+    cache.open(md5(second), filler(second, calls), md5(second)).close()
+    assert calls == [second]
+
+
+def test_entry_larger_than_the_budget_is_still_served(tmp_path):
+    cache = BinaryCache(str(tmp_path), 5)
+    data = b'x' * 10
+    with cache.open(md5(data), filler(data), md5(data)) as fileobj:
+        assert fileobj.read() == data
+
+
+def test_fill_with_the_wrong_content_is_rejected(tmp_path):
+    cache = BinaryCache(str(tmp_path), 100)
+    expected = md5(b'expected')
+    with pytest.raises(ValueError):
+        cache.open(expected, filler(b'something else'), expected)
+    assert os.listdir(str(tmp_path)) == []
+    assert cache.stats()['entries'] == 0
+
+
+def test_corrupt_file_left_by_another_process_is_refilled(tmp_path):
+    data = b'good data'
+    with open(os.path.join(str(tmp_path), md5(data)), 'wb') as corrupt_file:
+        corrupt_file.write(b'bad data!')
+    cache = BinaryCache(str(tmp_path), 100)
+    calls = []
+    with cache.open(md5(data), filler(data, calls), md5(data)) as fileobj:
+        assert fileobj.read() == data
+    assert calls == [data]
@@ -0,0 +1,12 @@
+from catalog import plan_lookups
+
+
+def test_plan_lookups():
+    plan = plan_lookups('armv8', 'prod', {'app1': 'beta', 'attrgamer': 'prod'})
+    assert plan == [('key', ('os_armv8', 'prod')), ('key', ('app1', 'beta')), ('attr', 'gamer#prod')]
+
+
+def test_reserved_rows_are_not_looked_up():
+    params = {'__catalog__': 'version', '__prebuilt__': 'x', 'app1': 'prod#attr#gamer', 'app2': 'prod'}
+    assert plan_lookups('armv8', 'prod', params) == [('key', ('os_armv8', 'prod')), ('key', ('app2', 'prod'))]
+    assert plan_lookups('armv8', 'prod#attr#gamer', {}) == []
@@ -0,0 +1,31 @@
+import handlers
+
+manifest = 'm' * 32
+base = {'version': '0.9', 'md5': 'b' * 32}
+
+
+def test_etag_is_the_manifest_when_the_client_has_nothing():
+    assert handlers.response_etag(manifest, frozenset()) == manifest
+
+
+def test_etag_depends_on_the_binaries_the_client_has():
+    assert handlers.response_etag(manifest, frozenset(['a' * 32])) != manifest
+    assert handlers.response_etag(manifest, frozenset(['a' * 32])) != handlers.response_etag(manifest, frozenset(['c' * 32]))
+
+
+def test_patched_and_full_archives_have_different_etags():
+    current_md5s = frozenset([base['md5']])
+    full = handlers.response_etag(manifest, current_md5s)
+    patched = handlers.response_etag(manifest, current_md5s, {'t' * 32: base})
+    assert patched != full
+    # No patch chosen is the same archive as a full one
+    assert handlers.response_etag(manifest, current_md5s, {}) == full
+    other_base = dict(base, md5='d' * 32)
+    assert handlers.response_etag(manifest, current_md5s, {'t' * 32: other_base}) != patched
+
+
+def test_nothing_to_fetch_once_the_client_has_every_binary():
+    items = [{'md5': 'a' * 32, 'url': 's3://bucket/a'}, {'md5': 'c' * 32, 'url': 's3://bucket/c'}]
+    assert handlers.has_binaries_to_fetch(items, set())
+    assert handlers.has_binaries_to_fetch(items, {'a' * 32})
+    assert not handlers.has_binaries_to_fetch(items, {'a' * 32, 'c' * 32})
@@ -0,0 +1,43 @@
+import hashlib
+import json
+import os
+
+from publisher import DirectoryTarget, generate_catalog, publish, random_binary
+
+
+def catalog_rows(directory):
+    with open(os.path.join(directory, 'catalog.json')) as catalog_file:
+        return [row for row in json.load(catalog_file) if 'md5' in row]
+
+
+def assert_catalog_matches_binaries(directory):
+    rows = catalog_rows(directory)
+    assert rows
+    for row in rows:
+        with open(os.path.join(directory, 'binaries', row['url'].rsplit('/', 1)[1]), 'rb') as binary_file:
+            data = binary_file.read()
+        assert row['md5'] == hashlib.md5(data).hexdigest(), row['app']
+        assert row['size'] == len(data)
+
+
+def test_random_binaries_are_published_with_their_md5(tmp_path):
+    entries = [({'app': 'app{0}'.format(a), 'env': 'prod', 'version': '1.0'}, random_binary(1000)) for a in range(3)]
+    publish(entries, DirectoryTarget(str(tmp_path)), concurrency=2)
+    assert_catalog_matches_binaries(str(tmp_path))
+
+
+def test_synthetic_catalog_is_published_with_its_md5s(tmp_path):
+    publish(generate_catalog(4, 2, 2, 1000), DirectoryTarget(str(tmp_path)), concurrency=2)
+    assert_catalog_matches_binaries(str(tmp_path))
+
+
+def test_republishing_keeps_the_replaced_version(tmp_path):
+    target = DirectoryTarget(str(tmp_path))
+    publish([({'app': 'app0', 'env': 'prod', 'version': '1.0'}, random_binary(100))], target)
+    first_md5 = catalog_rows(str(tmp_path))[0]['md5']
+    changed = publish([({'app': 'app0', 'env': 'prod', 'version': '1.1'}, random_binary(100))], target)
+
+    assert [i['version'] for i in changed] == ['1.1']
+    row = catalog_rows(str(tmp_path))[0]
+    assert row['previousVersions'][0]['md5'] == first_md5
+    assert_catalog_matches_binaries(str(tmp_path))
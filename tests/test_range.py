@@ -0,0 +1,86 @@
+import io
+
+import archive
+import handlers
+
+payload = bytes(range(100))
+etag = 'abc123'
+
+
+def payload_response(body=payload):
+    return handlers.create_http_response(body, 200, 'tar', etag)
+
+
+def test_parse_range():
+    assert handlers.parse_range(None, 100) is None
+    assert handlers.parse_range('bytes=-', 100) is None
+    assert handlers.parse_range('items=0-10', 100) is None
+    assert handlers.parse_range('bytes=10-19', 100) == (10, 19)
+    assert handlers.parse_range(' bytes=90- ', 100) == (90, 99)
+    # The last byte position is clamped to the payload
+    assert handlers.parse_range('bytes=90-500', 100) == (90, 99)
+
+
+def test_parse_suffix_range():
+    assert handlers.parse_range('bytes=-10', 100) == (90, 99)
+    # A suffix longer than the payload is the whole payload
+    assert handlers.parse_range('bytes=-500', 100) == (0, 99)
+    # An empty suffix can't be satisfied
+    assert handlers.parse_range('bytes=-0', 100) == (100, 99)
+
+
+def test_range_is_served():
+    response = handlers.apply_range(payload_response(), {'Range': 'bytes=10-19'})
+    assert response['status_code'] == 206
+    assert response['body'] == payload[10:20]
+    assert response['headers']['Content-Range'] == 'bytes 10-19/100'
+    assert response['headers']['Content-Length'] == '10'
+    assert response['headers']['Accept-Ranges'] == 'bytes'
+
+
+def test_suffix_range_is_served():
+    response = handlers.apply_range(payload_response(), {'Range': 'bytes=-5'})
+    assert response['status_code'] == 206
+    assert response['body'] == payload[95:]
+    assert response['headers']['Content-Range'] == 'bytes 95-99/100'
+
+
+def test_without_range_the_payload_length_is_sent():
+    response = handlers.apply_range(payload_response(), {})
+    assert response['status_code'] == 200
+    assert response['body'] == payload
+    assert response['headers']['Content-Length'] == '100'
+    assert response['headers']['Accept-Ranges'] == 'bytes'
+
+
+def test_reversed_range_is_ignored():
+    response = handlers.apply_range(payload_response(), {'Range': 'bytes=50-10'})
+    assert response['status_code'] == 200
+    assert response['body'] == payload
+
+
+def test_unsatisfiable_ranges():
+    for range_header in ('bytes=100-', 'bytes=150-200', 'bytes=-0'):
+        response = handlers.apply_range(payload_response(), {'Range': range_header})
+        assert response['status_code'] == 416, range_header
+        assert response['headers']['Content-Range'] == 'bytes */100'
+        assert response['headers']['Cache-Control'] == 'no-store'
+
+
+def test_if_range():
+    matching = handlers.apply_range(payload_response(), {'Range': 'bytes=0-9', 'If-Range': '"{0}"'.format(etag)})
+    assert matching['status_code'] == 206
+    assert matching['body'] == payload[:10]
+
+    # The client's partial copy is of another payload, so it gets the whole current one
+    other = handlers.apply_range(payload_response(), {'Range': 'bytes=0-9', 'If-Range': '"other"'})
+    assert other['status_code'] == 200
+    assert other['body'] == payload
+
+
+def test_range_of_archive_parts():
+    parts = archive.ArchiveParts([payload[:30], (40, io.BytesIO(payload[30:70])), payload[70:]])
+    response = handlers.apply_range(payload_response(parts), {'Range': 'bytes=25-74'})
+    assert response['status_code'] == 206
+    assert b''.join(response['body']) == payload[25:75]
+    assert response['headers']['Content-Range'] == 'bytes 25-74/100'